@@ -0,0 +1,229 @@
+"""Benchmarks for the core MiniVC operations on synthetic projects.
+
+Runs fully offline in a temporary directory and writes JSON results that
+can be compared across commits:
+
+    python benchmarks/bench_mvc.py --files 2000 --file-size 4096 -o before.json
+    python benchmarks/bench_mvc.py --files 2000 --file-size 4096 -o after.json
+    python benchmarks/bench_mvc.py --compare before.json after.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mvc.core import MiniVC
+from mvc.store import iter_chunks
+from mvc.trace import Tracer
+
+PROJECT = "bench"
+
+def tree_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+class Recorder:
+    def __init__(self, base_path: str, user_paths: list):
+        self.paths = [base_path, *user_paths]
+        self.results = {}
+
+    def measure(self, name: str, func, *args, **kwargs):
+        size_before = sum(tree_size(p) for p in self.paths)
+        tracemalloc.reset_peak()
+        with Tracer() as tracer:
+            start = time.perf_counter()
+            ret = func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        size_after = sum(tree_size(p) for p in self.paths)
+        entry = self.results.setdefault(name, {"seconds": [], "peak_bytes": [], "disk_growth_bytes": []})
+        entry["seconds"].append(seconds)
+        entry["peak_bytes"].append(peak)
+        entry["disk_growth_bytes"].append(max(0, size_after - size_before))
+        entry.setdefault("counters", []).append(tracer.report()["counters"])
+        return ret
+
+def write_files(user_path: str, names: list, size: int, rng: random.Random):
+    for name in names:
+        with open(os.path.join(user_path, name), 'wb') as f:
+            f.write(rng.randbytes(size))
+
+def measure_chunking(args, results: dict):
+    """Time content-defined chunking alone, on data held in memory.
+
+    Runs before tracemalloc is started, which would slow the per-candidate
+    hashing down several times.
+    """
+    data = random.Random(args.seed).randbytes(args.chunk_data << 20)
+    entry = results.setdefault("chunk_stream", {"seconds": [], "peak_bytes": [], "disk_growth_bytes": [], "counters": []})
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        chunks = sum(1 for _ in iter_chunks(io.BytesIO(data)))
+        seconds = time.perf_counter() - start
+        entry["seconds"].append(seconds)
+        entry["peak_bytes"].append(0)
+        entry["disk_growth_bytes"].append(0)
+        entry["counters"].append({"chunks": chunks, "mib_per_second": args.chunk_data / seconds})
+
+def run_scenario(args, root: str, rec_results: dict):
+    rng = random.Random(args.seed)
+    base_path = os.path.join(root, "base")
+    author_path = os.path.join(root, "author")
+    reader_path = os.path.join(root, "reader")
+    for path in (base_path, author_path, reader_path):
+        os.makedirs(path)
+    rec = Recorder(base_path, [author_path, reader_path])
+    rec.results = rec_results
+    names = [f"file{i:06d}.bin" for i in range(args.files)]
+    write_files(author_path, names, args.file_size, rng)
+
+    author = MiniVC(base_path, author_path, args.workers, args.link)
+    for i in range(args.projects - 1):
+        author.create(f"other{i:05d}")
+    rec.measure("create", author.create, PROJECT, args.chunked)
+    rec.measure("changes_all_new", author.changes)
+    rec.measure("submit_all", author.submit, names, "initial import")
+    rec.measure("changes_clean", author.changes)
+    rec.measure("save_initial", author.save, "initial save")
+
+    changed = max(1, int(len(names) * args.change_ratio))
+    for r in range(args.releases):
+        for s in range(args.submits):
+            subset = rng.sample(names, changed)
+            write_files(author_path, subset, args.file_size, rng)
+            rec.measure("changes_modified", author.changes)
+            rec.measure("submit_modified", author.submit, subset, f"change {r}.{s}")
+        rec.measure("status", author.status)
+        rec.measure("save", author.save, f"save {r}")
+        rec.measure("release", author.release, f"release {r}")
+
+    reader = MiniVC(base_path, reader_path, args.workers, args.link)
+    rec.measure("list_projects", reader.list_projects)
+    rec.measure("verify", reader.verify, PROJECT)
+    rec.measure("each_status", reader.each, list(reader.list_projects()), "status")
+    if args.releases > 0:
+        rec.measure("diff_first_release", reader.diff, PROJECT, 1, "latest")
+        def read_file(version):
+            with reader.open(PROJECT, names[0], version) as f:
+                return len(f.read())
+        rec.measure("open_first_release", read_file, 1)
+    recipe = rec.measure("load_plan", reader.load, PROJECT)
+    rec.measure("load_finalize", reader.load_finalize, recipe)
+    recipe = rec.measure("load_plan_noop", reader.load, PROJECT)
+    rec.measure("load_finalize_noop", reader.load_finalize, recipe)
+    lazy_reader = MiniVC(base_path, os.path.join(root, "lazy"), args.workers, args.link)
+    os.makedirs(lazy_reader.user_path)
+    rec.paths.append(lazy_reader.user_path)
+    recipe = rec.measure("load_plan_lazy", lazy_reader.load, PROJECT, lazy=True)
+    rec.measure("load_finalize_lazy", lazy_reader.load_finalize, recipe)
+    rec.measure("fetch_tenth", lazy_reader.fetch, names[:max(1, len(names) // 10)])
+    if args.releases > 1:
+        recipe = rec.measure("load_plan_release1", reader.load, PROJECT, 1)
+        rec.measure("load_finalize_release1", reader.load_finalize, recipe)
+
+    subset = rng.sample(names, changed)
+    write_files(author_path, subset, args.file_size, rng)
+    author.submit(subset, "for review")
+    recipe = rec.measure("review_plan", reader.review)
+    rec.measure("review_finalize", reader.review_finalize, recipe)
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def summarize(results: dict) -> dict:
+    return {name: {"seconds": min(entry["seconds"]),
+                   "peak_bytes": max(entry["peak_bytes"]),
+                   "disk_growth_bytes": max(entry["disk_growth_bytes"]),
+                   "counters": entry["counters"][0],
+                   "samples": len(entry["seconds"])}
+            for name, entry in results.items()}
+
+def run(args) -> dict:
+    results = {}
+    if args.chunk_data > 0:
+        measure_chunking(args, results)
+    tracemalloc.start()
+    try:
+        for _ in range(args.repeat):
+            root = tempfile.mkdtemp(prefix="mvc-bench-", dir=args.tmpdir)
+            try:
+                run_scenario(args, root, results)
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+    finally:
+        tracemalloc.stop()
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "tmpdir")}
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": params,
+        },
+        "results": summarize(results),
+    }
+
+def compare(old_file: str, new_file: str):
+    with open(old_file, 'r') as f:
+        old = json.load(f)["results"]
+    with open(new_file, 'r') as f:
+        new = json.load(f)["results"]
+    print(f"{'operation':<24}{'old s':>12}{'new s':>12}{'ratio':>8}{'old peak':>12}{'new peak':>12}")
+    for name in sorted(set(old) & set(new)):
+        o, n = old[name], new[name]
+        ratio = n["seconds"] / o["seconds"] if o["seconds"] else float("inf")
+        print(f"{name:<24}{o['seconds']:>12.4f}{n['seconds']:>12.4f}{ratio:>8.2f}"
+              f"{o['peak_bytes']:>12}{n['peak_bytes']:>12}")
+
+def main():
+    parser = argparse.ArgumentParser(description="MiniVC benchmarks")
+    parser.add_argument("--files", type=int, default=500, help="Number of files in the project")
+    parser.add_argument("--file-size", type=int, default=4096, help="Size of each file in bytes")
+    parser.add_argument("--submits", type=int, default=3, help="Submits per release")
+    parser.add_argument("--releases", type=int, default=3, help="Number of releases")
+    parser.add_argument("--projects", type=int, default=20, help="Number of projects in the base path")
+    parser.add_argument("--change-ratio", type=float, default=0.05, help="Share of files changed per submit")
+    parser.add_argument("--workers", type=int, default=None, help="Transfer worker threads")
+    parser.add_argument("--chunked", action="store_true", help="Create the project with chunked storage")
+    parser.add_argument("--chunk-data", type=int, default=16, help="MiB of data for the chunking throughput case, 0 to skip")
+    parser.add_argument("--link", choices=["auto", "copy", "hardlink"], default="auto", help="Link mode of checkouts")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of scenario runs; the fastest time is kept")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for file contents")
+    parser.add_argument("--tmpdir", default=None, help="Directory for the temporary base path")
+    parser.add_argument("--output", "-o", default=None, help="Write JSON results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run(args)
+    data = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+if __name__ == "__main__":
+    main()
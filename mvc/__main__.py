@@ -1,23 +1,58 @@
 import os
+import sys
+import json
 import argparse
-from .core import MiniVC, MVCError
+from dataclasses import asdict, is_dataclass
+from . import daemon
+from .helpers import MVCError, EACH_OPERATIONS, BLOCK_SIZE
+from .compress import CODECS
+from .transfer import LINK_MODES
 
-def main():
+def add_sparse_arguments(parser):
+    parser.add_argument("--include", action="append", metavar="PATTERN", help="Only check out files matching this glob or below this directory")
+    parser.add_argument("--exclude", action="append", metavar="PATTERN", help="Leave out files matching this glob or below this directory")
+    parser.add_argument("--full", action="store_true", help="Drop the patterns of the previous checkout")
+    parser.add_argument("--lazy", action="store_true", help="Only list missing files in the workspace until fetched")
+
+def sparse_arguments(args) -> tuple:
+    if args.full:
+        return args.include or [], args.exclude or [], args.lazy
+    return args.include, args.exclude, args.lazy
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="miniVC CLI")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel file transfers")
+    parser.add_argument("--link", choices=LINK_MODES, default=os.getenv("MINIVC_LINK", "auto"),
+                        help="auto: reflink checkouts where supported; hardlink: fall back to read-only hardlinks; copy: always copy")
+    parser.add_argument("--profile", action="store_true", help="Print counters and phase timings as JSON to stderr")
+    parser.add_argument("--trace", metavar="FILE", default=None, help="Write a Chrome trace-event file")
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     # create
     parser_create = subparsers.add_parser("create", help="Create a new project")
     parser_create.add_argument("project", help="Project name")
+    parser_create.add_argument("--chunked", action="store_true", help="Store large files as deduplicated chunks")
+    parser_create.add_argument("--compress", choices=list(CODECS), default="", help="Store files compressed with this codec")
 
     # load
     parser_load = subparsers.add_parser("load", help="Load a project")
     parser_load.add_argument("project", help="Project name")
     parser_load.add_argument("--version", default="latest", help="Version to load (default: latest)")
+    add_sparse_arguments(parser_load)
+
+    # fetch
+    parser_fetch = subparsers.add_parser("fetch", help="Write lazily loaded files into the workspace")
+    parser_fetch.add_argument("patterns", nargs='*', help="Globs or directories to fetch (default: all)")
+
+    # cat
+    parser_cat = subparsers.add_parser("cat", help="Write one file of a version to stdout")
+    parser_cat.add_argument("project", help="Project name")
+    parser_cat.add_argument("path", help="File path in the project")
+    parser_cat.add_argument("--version", default="latest", help="Release number, latest or dev (default: latest)")
 
     # submit
     parser_submit = subparsers.add_parser("submit", help="Submit changes")
-    parser_submit.add_argument("files", nargs='+', help="Files to submit")
+    parser_submit.add_argument("files", nargs='+', help="Files or directories to submit")
     parser_submit.add_argument("--description", "-d", help="Description for this submit")
 
     # save
@@ -27,18 +62,107 @@ def main():
     # release
     parser_release = subparsers.add_parser("release", help="Release a project version")
 
+    # batch
+    parser_batch = subparsers.add_parser("batch", help="Run the submit, remove, save and release steps of a JSON manifest")
+    parser_batch.add_argument("manifest", help="JSON file with a list of steps")
+
+    # pack
+    parser_pack = subparsers.add_parser("pack", help="Pack old releases into a single pack file")
+    parser_pack.add_argument("project", help="Project name")
+    parser_pack.add_argument("--keep", type=int, default=1, help="Number of recent releases to keep loose (default: 1)")
+
+    # unlock
+    parser_unlock = subparsers.add_parser("unlock", help="Break the lock of a project whose owner is gone")
+    parser_unlock.add_argument("project", help="Project name")
+
+    # diff
+    parser_diff = subparsers.add_parser("diff", help="List the files that differ between two versions")
+    parser_diff.add_argument("project", help="Project name")
+    parser_diff.add_argument("a", nargs='?', default="latest", help="Release number, latest or dev (default: latest)")
+    parser_diff.add_argument("b", nargs='?', default="dev", help="Release number, latest or dev (default: dev)")
+
+    # gc
+    parser_gc = subparsers.add_parser("gc", help="Delete storage that no version can reach")
+    parser_gc.add_argument("project", nargs='?', default=None, help="Project name (default: all projects)")
+    parser_gc.add_argument("--keep", type=int, default=None, help="Pack the objects of all but the last KEEP releases")
+    parser_gc.add_argument("--dry-run", action="store_true", help="Only report the reclaimable storage")
+
+    # each
+    parser_each = subparsers.add_parser("each", help="Run an operation on many projects in parallel")
+    parser_each.add_argument("--projects", action="append", metavar="NAMES", help="Comma separated project names (default: all projects)")
+    parser_each.add_argument("--prefix", default="", help="Only projects starting with this prefix")
+    parser_each.add_argument("--pending", action="store_true", help="Only projects with unsaved submits")
+    parser_each.add_argument("--concurrency", type=int, default=4, help="Projects handled at once (default: 4)")
+    parser_each.add_argument("--description", "-d", default="", help="Description for save and release")
+    parser_each.add_argument("--keep", type=int, default=None, help="Releases to keep unpacked for pack and gc")
+    parser_each.add_argument("operation", choices=EACH_OPERATIONS, help="Operation to run on every project")
+
+    # verify
+    parser_verify = subparsers.add_parser("verify", help="Check stored content against its checksums")
+    parser_verify.add_argument("project", nargs='?', help="Project to verify (default: all projects)")
+    parser_verify.add_argument("--memory", type=int, default=64, help="Memory budget in MiB (default: 64)")
+
     # review
     parser_review = subparsers.add_parser("review", help="Review submitted files")
+    add_sparse_arguments(parser_review)
 
     # list
     parser_list = subparsers.add_parser("list", help="Get a list of projects")
+    parser_list.add_argument("prefix", nargs='?', default="", help="Only list projects starting with this prefix")
+    parser_list.add_argument("--offset", type=int, default=0, help="Number of projects to skip")
+    parser_list.add_argument("--limit", type=int, default=None, help="Maximum number of projects to list")
+    parser_list.add_argument("--min-release", type=int, default=None, help="Only list projects with at least this release")
+    parser_list.add_argument("--pending", action="store_true", default=None, help="Only list projects with unsaved submits")
+
+    # rebuild
+    parser_rebuild = subparsers.add_parser("rebuild", help="Rebuild the project catalog from the project directories")
 
     # status
     parser_status = subparsers.add_parser("status", help="Get the versions and submits in the project")
 
-    args = parser.parse_args()
-    
-    mvc = MiniVC(os.getenv('MINIVC_BASE_PATH', 'mvc-files'), os.getcwd())
+    # daemon
+    parser_daemon = subparsers.add_parser("daemon", help="Serve CLI commands from a long-lived process")
+
+    # serve
+    parser_serve = subparsers.add_parser("serve", help="Serve the base path to remote clients over HTTP, without authentication")
+    parser_serve.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser_serve.add_argument("--port", type=int, default=8750, help="Port to listen on (default: 8750)")
+    parser_serve.add_argument("--allow-remote", action="store_true",
+                              help="Listen on a non-loopback address; clients are not authenticated")
+    return parser
+
+def execute(argv: list[str] = None, cwd: str = None):
+    args = build_parser().parse_args(argv)
+    cwd = cwd or os.getcwd()
+    base_path = os.getenv('MINIVC_BASE_PATH', 'mvc-files')
+    if args.command == "daemon":
+        daemon.serve(daemon.get_socket_path(base_path), cli)
+        return
+    if args.command == "serve":
+        from .remote import serve
+        serve(base_path, args.host, args.port, args.workers, args.allow_remote)
+        return
+
+    from .trace import Tracer
+    if base_path.startswith(("http://", "https://")):
+        from .remote import RemoteMiniVC
+        mvc = RemoteMiniVC(base_path, cwd, args.workers)
+    else:
+        from .core import MiniVC
+        mvc = MiniVC(base_path, cwd, args.workers, args.link)
+    if not (args.profile or args.trace):
+        run(mvc, args, cwd)
+        return
+    with Tracer() as tracer:
+        try:
+            run(mvc, args, cwd)
+        finally:
+            if args.profile:
+                print(json.dumps(tracer.report(), indent=4), file=sys.stderr)
+            if args.trace:
+                tracer.write_chrome_trace(os.path.join(cwd, args.trace))
+
+def run(mvc, args, cwd: str):
     # parse commands
     if args.command == "submit":
         description = args.description or "no description"
@@ -52,22 +176,135 @@ def main():
         mvc.release()
     
     if args.command == "create":
-        mvc.create(args.project)
+        mvc.create(args.project, args.chunked, args.compress)
     
     elif args.command == 'list':
-        print(mvc.list())
+        projects = mvc.list_projects(args.prefix, args.offset, args.limit, args.min_release, args.pending)
+        for name, id in projects.items():
+            print(f"{name}\t{id}")
+
+    elif args.command == "rebuild":
+        print(f"catalog rebuilt with {mvc.rebuild_catalog()} projects")
 
     elif args.command == "load":
-        mvc.load(args.project, args.version)
+        if args.version == "latest":
+            release = -1
+        elif args.version.lstrip("v").isdigit():
+            release = int(args.version.lstrip("v"))
+        else:
+            raise MVCError(f"Invalid version {args.version}.")
+        mvc.load_finalize(mvc.load(args.project, release, *sparse_arguments(args)))
+
+    elif args.command == "cat":
+        out = sys.stdout.buffer
+        with mvc.open(args.project, args.path, args.version) as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                out.write(block)
+        out.flush()
+
+    elif args.command == "fetch":
+        print(f"fetched {len(mvc.fetch(args.patterns or None))} files")
 
     elif args.command == 'status':
         print(mvc.status())
 
     elif args.command == "review":
-        mvc.review()
-    
-if __name__ == "__main__":
+        mvc.review_finalize(mvc.review(*sparse_arguments(args)))
+
+    elif args.command == "batch":
+        with open(os.path.join(cwd, args.manifest), 'r') as fd:
+            steps = json.load(fd)
+        for name, id in mvc.batch(steps).items():
+            print(f"{name}\t{id}")
+
+    elif args.command == "pack":
+        print(f"packed {mvc.pack(args.project, args.keep)} objects")
+
+    elif args.command == "unlock":
+        owner = mvc.unlock(args.project)
+        print(f"removed lock of {owner.get('host', 'unknown host')}:{owner.get('pid', 'unknown pid')}")
+
+    elif args.command == "diff":
+        diff = mvc.diff(args.project, args.a, args.b)
+        for status, files in (("A", diff.added), ("D", diff.removed), ("M", diff.modified)):
+            for file in files:
+                print(f"{status}\t{file}")
+
+    elif args.command == "each":
+        if args.projects:
+            names = [name for names in args.projects for name in names.split(",") if name]
+            names = [name for name in names if name.startswith(args.prefix)]
+        else:
+            names = list(mvc.list_projects(args.prefix, pending=True if args.pending else None))
+        extra = ()
+        if args.operation in ("save", "release"):
+            extra = (args.description or "no description",)
+        elif args.operation == "pack":
+            extra = (1 if args.keep is None else args.keep,)
+        elif args.operation == "gc":
+            extra = (args.keep,)
+        results = mvc.each(names, args.operation, *extra, concurrency=args.concurrency)
+        for result in results:
+            if result.error is not None:
+                print(f"{result.project_name}\tError: {result.error}")
+            elif is_dataclass(result.result):
+                print(f"{result.project_name}\t{json.dumps(asdict(result.result))}")
+            elif isinstance(result.result, list):
+                print(f"{result.project_name}\t{json.dumps(result.result)}")
+            else:
+                print(f"{result.project_name}\t{result.result}")
+        failed = sum(result.error is not None for result in results)
+        if failed:
+            raise MVCError(f"{failed} of {len(results)} projects failed.")
+
+    elif args.command == "verify":
+        failed = 0
+        for report in mvc.verify(args.project, args.memory << 20):
+            state = f"{len(report.corrupt)} corrupt, {len(report.missing)} missing" if report.corrupt or report.missing else "ok"
+            print(f"{report.project_name}\t{report.objects} objects\t{report.size} bytes\t{state}")
+            for digest in report.corrupt:
+                print(f"corrupt\t{report.project_name}\t{digest}")
+            for digest in report.missing:
+                print(f"missing\t{report.project_name}\t{digest}")
+            failed += len(report.corrupt) + len(report.missing)
+        if failed:
+            raise MVCError(f"{failed} objects failed verification.")
+
+    elif args.command == "gc":
+        state = "reclaimable" if args.dry_run else "reclaimed"
+        for name in [args.project] if args.project else mvc.list_projects():
+            report = mvc.gc(name, args.keep, args.dry_run)
+            print(f"{name}\t{len(report.paths)} files\t{len(report.packed)} packed objects\t{report.size} bytes {state}")
+
+def cli(argv: list[str], cwd: str) -> int:
     try:
-        main()
+        execute(argv, cwd)
     except MVCError as e:
         print("Error:", e)
+        return 1
+    return 0
+
+def main(argv: list[str] = None):
+    """Entry point of the mvc command, running it in the daemon when one is listening."""
+    argv = sys.argv[1:] if argv is None else argv
+    code = None
+    # the daemon only relays text output
+    if build_parser().parse_args(argv).command not in ("daemon", "serve", "cat"):
+        try:
+            socket_path = daemon.get_socket_path(os.getenv('MINIVC_BASE_PATH', 'mvc-files'))
+        except MVCError as e:
+            # without a safe place for the socket, no daemon can be trusted
+            print(f"Warning: {e} Running without the daemon.", file=sys.stderr)
+            socket_path = None
+        try:
+            if socket_path is not None:
+                code = daemon.forward(socket_path, argv, os.getcwd())
+        except MVCError as e:
+            print("Error:", e)
+            code = 1
+    if code is None:
+        code = cli(argv, os.getcwd())
+    sys.exit(code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import asyncio
+import functools
+from typing import List
+
+from mvc import trace
+from mvc.core import MiniVC
+from mvc.helpers import FileOperation, ProjectResult
+
+class AsyncMiniVC:
+    """Asyncio front end to MiniVC.
+
+    Operations run on an executor so the event loop never blocks on the
+    filesystem, and a semaphore caps how many of them run at once. Pass the
+    same semaphore to the instances of several users to share one limit
+    across a service process. File copies inside an operation are spread
+    over the MiniVC transfer engine.
+
+    Operations that read or write the workspace (its .mvc, index and files)
+    run one at a time per instance, in the order they were awaited, while
+    the project-only ones (read, each, list_projects) run concurrently.
+    Several instances on the same user_path are not serialized against each
+    other, so a workspace should have a single AsyncMiniVC.
+    """
+
+    def __init__(self, base_path: str, user_path: str, workers: int = None,
+                 concurrency: int = 8, semaphore: asyncio.Semaphore = None, executor=None, link: str = "auto"):
+        self.mvc = MiniVC(base_path, user_path, workers, link)
+        self.concurrency = concurrency
+        self._semaphore = semaphore
+        self._executor = executor
+        self._workspace_lock = None
+
+    async def _run(self, func, *args, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, trace.bind(functools.partial(func, *args, **kwargs)))
+
+    async def _run_in_workspace(self, func, *args, **kwargs):
+        if self._workspace_lock is None:
+            self._workspace_lock = asyncio.Lock()
+        async with self._workspace_lock:
+            return await self._run(func, *args, **kwargs)
+
+    async def create(self, name: str, chunking: bool = False, compression: str = ""):
+        return await self._run_in_workspace(self.mvc.create, name, chunking, compression)
+
+    async def submit(self, files: List[str], comment: str = ""):
+        return await self._run_in_workspace(self.mvc.submit, files, comment)
+
+    async def remove(self, files: List[str], comment: str = ""):
+        return await self._run_in_workspace(self.mvc.remove, files, comment)
+
+    async def save(self, comment: str = ""):
+        return await self._run_in_workspace(self.mvc.save, comment)
+
+    async def release(self, comment: str = ""):
+        return await self._run_in_workspace(self.mvc.release, comment)
+
+    async def batch(self, steps: List[dict]) -> dict[str, str]:
+        return await self._run_in_workspace(self.mvc.batch, steps)
+
+    async def load(self, project_name: str, release: int = -1, include: List[str] = None,
+                   exclude: List[str] = None, lazy: bool = False) -> FileOperation:
+        return await self._run_in_workspace(self.mvc.load, project_name, release, include, exclude, lazy)
+
+    async def load_finalize(self, recipe: FileOperation):
+        return await self._run_in_workspace(self.mvc.load_finalize, recipe)
+
+    async def review(self, include: List[str] = None, exclude: List[str] = None, lazy: bool = False) -> FileOperation:
+        return await self._run_in_workspace(self.mvc.review, include, exclude, lazy)
+
+    async def review_finalize(self, recipe: FileOperation):
+        return await self._run_in_workspace(self.mvc.review_finalize, recipe)
+
+    async def fetch(self, patterns: List[str] = None) -> List[str]:
+        return await self._run_in_workspace(self.mvc.fetch, patterns)
+
+    async def read(self, project_name: str, path: str, version="latest") -> bytes:
+        def read():
+            with self.mvc.open(project_name, path, version) as f:
+                return f.read()
+        return await self._run(read)
+
+    async def each(self, projects: List[str], operation: str, *args, concurrency: int = 4) -> List[ProjectResult]:
+        return await self._run(self.mvc.each, projects, operation, *args, concurrency=concurrency)
+
+    async def list_projects(self, *args, **kwargs) -> dict[str, str]:
+        return await self._run(self.mvc.list_projects, *args, **kwargs)
+
+    async def status(self) -> List[str]:
+        return await self._run_in_workspace(self.mvc.status)
+
+    async def contents(self) -> List[str]:
+        return await self._run_in_workspace(self.mvc.contents)
+
+    async def changes(self) -> List[str]:
+        return await self._run_in_workspace(self.mvc.changes)
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+from contextlib import closing
+
+from mvc import trace
+from mvc.helpers import MVCError, Project, FileID
+
+CATALOG_FILE = ".mvc-catalog.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    name TEXT PRIMARY KEY,
+    release INTEGER NOT NULL,
+    save INTEGER NOT NULL,
+    submit INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS built (
+    complete INTEGER NOT NULL
+);"""
+
+class Catalog:
+    """Index of the projects in a base path, kept in a SQLite database.
+
+    The catalog only counts as present once a rebuild has filled it from
+    the project directories. Until then updates are skipped, so a missing
+    or deleted database is never replaced by one listing only the projects
+    changed since.
+    """
+
+    def __init__(self, base_path: str):
+        self.base_path = base_path
+        self.filename = os.path.join(base_path, CATALOG_FILE)
+
+    def exists(self) -> bool:
+        if not os.path.exists(self.filename):
+            return False
+        with closing(self._connect()) as conn:
+            return self._is_built(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _is_built(self, conn) -> bool:
+        return conn.execute("SELECT 1 FROM built").fetchone() is not None
+
+    @trace.traced("catalog.update")
+    def update(self, project: Project):
+        if not os.path.exists(self.filename):
+            return
+        with closing(self._connect()) as conn, conn:
+            if not self._is_built(conn):
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+                (project.name, project.id.release, project.id.save, project.id.submit))
+
+    @trace.traced("catalog.query")
+    def query(self, prefix: str = "", offset: int = 0, limit: int = None,
+              min_release: int = None, pending: bool = None) -> dict[str, str]:
+        sql = "SELECT name, release, save, submit FROM projects WHERE name >= ?"
+        params = [prefix]
+        if prefix:
+            sql += " AND name < ?"
+            params.append(prefix + chr(0x10ffff))
+        if min_release is not None:
+            sql += " AND release >= ?"
+            params.append(min_release)
+        if pending is not None:
+            sql += " AND submit > 0" if pending else " AND submit = 0"
+        sql += " ORDER BY name LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return {name: str(FileID(*id)) for name, *id in rows}
+
+    @trace.traced("catalog.rebuild")
+    def rebuild(self) -> int:
+        """Recreate the catalog from the project directories, skipping stray entries."""
+        projects = []
+        for entry in os.scandir(self.base_path):
+            if not entry.is_dir():
+                continue
+            try:
+                projects.append(Project.load(entry.path))
+            except (OSError, ValueError, TypeError, MVCError):
+                continue
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM projects")
+            conn.executemany(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+                [(p.name, p.id.release, p.id.save, p.id.submit) for p in projects])
+            conn.execute("DELETE FROM built")
+            conn.execute("INSERT INTO built VALUES (1)")
+        return len(projects)
@@ -0,0 +1,97 @@
+import io
+import bz2
+import lzma
+import zlib
+from dataclasses import dataclass
+
+from mvc.helpers import MVCError, BLOCK_SIZE
+
+# a sample that zlib cannot shrink below this ratio is stored as is
+SAMPLE_SIZE = 64 << 10
+MIN_RATIO = 0.9
+
+class _ZlibDecompressor:
+    """zlib.decompressobj behind the decompress(data, max_length) interface of lzma and bz2."""
+
+    def __init__(self):
+        self._d = zlib.decompressobj()
+        self.needs_input = True
+
+    @property
+    def eof(self):
+        return self._d.eof
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        out = self._d.decompress(self._d.unconsumed_tail + data, max_length)
+        self.needs_input = not self._d.unconsumed_tail
+        return out
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    suffix: str
+    kind: int
+    compressor: type
+    decompressor: type
+
+CODECS = {
+    "zlib": Codec("zlib", ".zz", 2, lambda: zlib.compressobj(6), _ZlibDecompressor),
+    "lzma": Codec("lzma", ".xz", 3, lzma.LZMACompressor, lzma.LZMADecompressor),
+    "bz2": Codec("bz2", ".bz2", 4, bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+
+def get_codec(name: str):
+    if not name:
+        return None
+    if name not in CODECS:
+        raise MVCError(f"Unknown compression {name!r}, choose from {', '.join(CODECS)}.")
+    return CODECS[name]
+
+def is_compressible(sample: bytes) -> bool:
+    """Whether a quick zlib pass shrinks the sample; false for already compressed formats."""
+    sample = sample[:SAMPLE_SIZE]
+    return len(sample) > 0 and len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO
+
+KIND_CODECS = {codec.kind: codec for codec in CODECS.values()}
+
+def compress_stream(codec: Codec, fsrc, fdst, sha=None) -> int:
+    """Compress fsrc into fdst one block at a time, returning the compressed size.
+
+    sha, a hashlib object, is updated with the uncompressed bytes on the way.
+    """
+    compressor = codec.compressor()
+    size = 0
+    for block in iter(lambda: fsrc.read(BLOCK_SIZE), b''):
+        if sha is not None:
+            sha.update(block)
+        out = compressor.compress(block)
+        fdst.write(out)
+        size += len(out)
+    out = compressor.flush()
+    fdst.write(out)
+    return size + len(out)
+
+class DecompressReader(io.RawIOBase):
+    """Read-only stream decompressing another stream, holding at most one block of output."""
+
+    def __init__(self, raw, codec: Codec):
+        self._raw = raw
+        self._d = codec.decompressor()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._d.eof:
+            data = self._raw.read(BLOCK_SIZE) if self._d.needs_input else b""
+            out = self._d.decompress(data, len(b))
+            if out:
+                b[:len(out)] = out
+                return len(out)
+            if not data and self._d.needs_input and not self._d.eof:
+                raise MVCError("Compressed object is truncated.")
+        return 0
+
+    def close(self):
+        self._raw.close()
+        super().close()
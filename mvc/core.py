@@ -1,29 +1,154 @@
 import os
+import copy
+import json
 import shutil
 from typing import List
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from mvc.helpers import MVCError, Version, Project, Workspace, FileOperation, FileID, get_submit_path, get_stable_path, get_release_path, list_files_dir
+from mvc.helpers import MVCError, BLOCK_SIZE, Version, Project, Workspace, FileOperation, GarbageReport, VerifyReport, ProjectResult, EACH_OPERATIONS, STORE_LAYOUT, FileDiff, FileID, check_project_name, get_tmp_path, get_submit_path, get_stable_path, get_release_path, get_dev_log_path, get_objects_path, get_packs_path
+from mvc import trace
+from mvc.store import BlobStore
+from mvc.compress import get_codec
+from mvc.scan import IgnoreRules, scan_tree, normalize_path, is_under, select_paths
+from mvc.index import WorkspaceIndex
+from mvc.transfer import TransferEngine, LINK_MODES, detect_link_mode
+from mvc.catalog import Catalog
+from mvc.transaction import ProjectLock, Transaction, recover
 
 class MiniVC:
+    def _export_files(self, project_name: str, files: dict[str, str]):
+        """Write the stored content of files ({file: digest}) into the workspace."""
+        store = self._get_store(self._project_path(project_name))
+        def export(item):
+            dst_path = os.path.join(self.user_path, item[0])
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            store.export(item[1], dst_path)
+        self.transfer.run(export, list(files.items()))
+
+    @trace.traced("execute")
     def _execute(self, recipe: FileOperation):
-        for file, path in recipe.files_to_add.items():
-            file_path = os.path.join(path, file)
-            shutil.copy2(file_path, self.user_path)
+        self._export_files(recipe.project_name, recipe.files_to_add)
+        # exports check the content against its digest, so it need not be hashed again
+        index = WorkspaceIndex(self.user_path, self.transfer.workers)
+        index.record(recipe.files_to_add)
+        index.save()
         for file in recipe.files_to_remove:
             file_path = os.path.join(self.user_path, file)
             os.remove(file_path)
+            # drop directories left empty
+            parent = os.path.dirname(file)
+            while parent:
+                try:
+                    os.rmdir(os.path.join(self.user_path, parent))
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        workspace = self._get_workspace()
+        if workspace is None or workspace.project != recipe.project_name:
+            workspace = Workspace(recipe.project_name)
+        for file in recipe.files_to_remove:
+            workspace.files.pop(file, None)
+        for file, digest in recipe.version_files.items():
+            if file in recipe.lazy:
+                workspace.files.pop(file, None)
+            else:
+                workspace.files[file] = digest
+        workspace.lazy = dict(recipe.lazy)
+        workspace.include = list(recipe.include)
+        workspace.exclude = list(recipe.exclude)
+        workspace.save(self.user_path)
+
+    @trace.traced("sync.plan")
+    def _sync_operation(self, project_name: str, md: List[str], version_files: dict[str, str],
+                        include: List[str] = None, exclude: List[str] = None, lazy: bool = False) -> FileOperation:
+        """Plan bringing the workspace to version_files.
+
+        Only files matching include and not exclude are checked out; without
+        patterns, those of the previous checkout of the project apply. With
+        lazy, files missing from the workspace are only listed in it, to be
+        written by fetch.
+        """
+        workspace = self._get_workspace()
+        tracked = workspace.files if workspace is not None else {}
+        if include is None and exclude is None and workspace is not None and workspace.project == project_name:
+            include, exclude = workspace.include, workspace.exclude
+        selected = {f: version_files[f] for f in select_paths(version_files, include, exclude)}
+        present = [f for f in set(selected) | set(tracked)
+                   if os.path.isfile(os.path.join(self.user_path, f))]
+        index = WorkspaceIndex(self.user_path, self.transfer.workers)
+        hashes = index.hashes(present)
+        index.save()
+        files_to_add = {f: d for f, d in selected.items() if hashes.get(f) != d}
+        deferred = {}
+        if lazy:
+            deferred = {f: d for f, d in files_to_add.items() if f not in hashes}
+            files_to_add = {f: d for f, d in files_to_add.items() if f not in deferred}
+        files_to_remove = [f for f, d in tracked.items()
+                           if f not in selected and hashes.get(f) == d]
+        return FileOperation(
+            project_name,
+            md,
+            files_to_add,
+            files_to_remove,
+            selected,
+            deferred,
+            list(include or []),
+            list(exclude or []))
     
+    def _append_dev_log(self, project_path: str, submit: int, description: List[str]):
+        with open(os.path.join(project_path, get_dev_log_path()), 'a') as fd:
+            fd.write(json.dumps({"submit": submit, "description": description}) + "\n")
+
+    def _get_dev_log(self, project_path: str, submits: int, tr: Transaction = None) -> List[str]:
+        entries = {}
+        try:
+            with open(os.path.join(project_path, get_dev_log_path()), 'r') as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries[entry["submit"]] = entry["description"]
+        except FileNotFoundError:
+            pass
+        md = []
+        for i in range(submits, 0, -1):
+            if i not in entries:
+                # submits made before the log existed, or interrupted before logging
+                version_path = os.path.join(project_path, get_submit_path(i))
+                version = tr.load(Version, version_path) if tr else Version.load(version_path)
+                entries[i] = version.description
+            md += entries[i]
+        return md
+
+    def _get_release_log(self, project_path: str, release: int) -> List[str]:
+        """Descriptions of releases 1..release, newest first, cached in each release directory."""
+        missing = []
+        md = []
+        while release > 0:
+            filename = os.path.join(project_path, get_release_path(release), "changelog.md")
+            try:
+                with open(filename, 'r') as fd:
+                    md = fd.read().splitlines()
+                break
+            except FileNotFoundError:
+                missing.append(release)
+                release -= 1
+        for i in reversed(missing):
+            version_path = os.path.join(project_path, get_release_path(i))
+            md = Version.load(version_path).description + md
+            self._write_markdown(version_path, md)
+        return md
+
+    @trace.traced("history")
     def _get_history_markdown(self, project: Project) -> list[str]:
         md = []
         project_path = os.path.join(self.base_path, project.name)
         if project.id.submit > 0:
             md.append(f"# development version")
-        for i in range(project.id.submit, 0, -1):
-            version_path = os.path.join(project_path, get_submit_path(i))
-            version = Version.load(version_path)
-            for line in version.description:
-                md.append(line)
+            md += self._get_dev_log(project_path, project.id.submit)
         
         if project.id.save > 0:
             md.append(f"# stable version")
@@ -34,30 +159,153 @@ class MiniVC:
         
         if project.id.release > 0:
             md.append(f"# Release version")
-        for i in range(project.id.release, 0, -1):
-            version_path = os.path.join(project_path, get_release_path(i))
-            version = Version.load(version_path)
-            for line in version.description:
-                md.append(line)
+            md += self._get_release_log(project_path, project.id.release)
         return md
     
     def _write_markdown(self, dst_path: str, md: List[str]):
+        # written aside and renamed, so a reader of a cached release log never sees it partly written
         filename = os.path.join(dst_path, "changelog.md")
-        with open(filename, 'w') as fd:
+        tmp_path = get_tmp_path(filename)
+        with open(tmp_path, 'w') as fd:
             for line in md:
                 fd.write(line + "\n")
+        os.replace(tmp_path, filename)
 
     def _current_timestamp(self) -> str:
         return datetime.now().strftime("%d/%m/%Y %H:%M:%S")
 
-    def _get_project(self, project_name):
+    def _get_project(self, project_name, locked: bool = False):
+        project_path = self._project_path(project_name)
         try:
-            project_path = os.path.join(self.base_path, project_name)
             project = Project.load(project_path)
-            return project, project_path
         except FileNotFoundError:
             raise MVCError("Invalid project name.")     
+        if project.layout < STORE_LAYOUT:
+            project = self._import_loose_files(project_path, locked)
+        return project, project_path
+
+    def _import_loose_files(self, project_path: str, locked: bool) -> Project:
+        """Move the files kept in the version directories of older projects into the blob store."""
+        if not locked:
+            with ProjectLock(project_path):
+                recover(project_path)
+                return self._import_loose_files(project_path, True)
+        project = Project.load(project_path)
+        if project.layout >= STORE_LAYOUT:
+            return project
+        store = self._get_store(project_path, project.chunking, project.compression)
+        tr = Transaction(project_path)
+        loose = []
+        sizes = {}
+        sub_paths = [get_stable_path()]
+        sub_paths += [get_release_path(i) for i in range(1, project.id.release + 1)]
+        sub_paths += [get_submit_path(i) for i in range(1, project.id.submit + 1)]
+        imported = []
+        for sub_path in sub_paths:
+            version_path = os.path.join(project_path, sub_path)
+            if not os.path.isdir(version_path):
+                continue
+            version = tr.load(Version, version_path)
+            if version.blobs or version.files:
+                continue
+            for name in sorted(os.listdir(version_path)):
+                path = os.path.join(version_path, name)
+                if name.startswith(".mvc") or name == "changelog.md" or not os.path.isfile(path):
+                    continue
+                version.blobs[name] = store.put(path)
+                sizes[version.blobs[name]] = os.path.getsize(path)
+                loose.append(path)
+            imported.append((version, version_path))
+        # write the manifests now, while the sizes are known without reading the objects
+        for version, version_path in imported:
+            try:
+                version.files = self._manifest_files(project_path, version, tr)
+            except MVCError:
+                # left to be resolved when the version is read
+                version.files = {}
+            version.sizes = {file: sizes[digest] if digest in sizes else store.size(digest)
+                             for file, digest in version.files.items()}
+            tr.save(version, version_path)
+        project.layout = STORE_LAYOUT
+        def remove_loose():
+            for path in loose:
+                os.remove(path)
+        tr.on_commit(remove_loose)
+        self._commit(tr, project, project_path)
+        return project
     
+    def _project_path(self, project_name: str) -> str:
+        return os.path.join(self.base_path, check_project_name(project_name))
+
+    def _get_store(self, project_path: str, chunking: bool = False, compression: str = "") -> BlobStore:
+        return BlobStore(
+            os.path.join(project_path, get_objects_path()),
+            chunking,
+            os.path.join(project_path, get_packs_path()),
+            compression,
+            detect_link_mode(self.base_path, self.link))
+
+    def _resolve_includes(self, project_path: str, include: dict[str, FileID],
+                          tr: Transaction = None) -> dict[str, str]:
+        tr = tr or Transaction(project_path)
+        blobs = {}
+        for file, file_id in include.items():
+            version = tr.load(Version, os.path.join(project_path, file_id.sub_path))
+            if file not in version.blobs:
+                raise MVCError(f"{file} is missing from version {file_id}.")
+            blobs[file] = version.blobs[file]
+        return blobs
+
+    def _manifest_files(self, project_path: str, version: Version, tr: Transaction = None) -> dict[str, str]:
+        """Digest of every file in the version, resolved through include for versions without a manifest."""
+        if version.files or not (version.blobs or version.include):
+            return version.files
+        files = dict(version.blobs)
+        files.update(self._resolve_includes(project_path, version.include, tr))
+        return files
+
+    def _manifest(self, project_path: str, version: Version,
+                  tr: Transaction = None) -> tuple[dict[str, str], dict[str, int]]:
+        """Digest and size of every file in the version, for the callers writing a manifest."""
+        if version.files or not (version.blobs or version.include):
+            return version.files, version.sizes
+        files = self._manifest_files(project_path, version, tr)
+        store = self._get_store(project_path)
+        return files, {file: store.size(digest) for file, digest in files.items()}
+
+    def _version_path(self, project: Project, project_path: str, version) -> str:
+        """Directory of a release number, "latest" for the saved version or "dev" for the last submit."""
+        if version == "latest" or (version == "dev" and project.id.submit == 0):
+            return os.path.join(project_path, get_stable_path())
+        if version == "dev":
+            return os.path.join(project_path, get_submit_path(project.id.submit))
+        try:
+            release = int(str(version).removeprefix("v"))
+        except ValueError:
+            raise MVCError("Invalid version")
+        if not 0 < release <= project.id.release:
+            raise MVCError("Invalid version")
+        return os.path.join(project_path, get_release_path(release))
+
+    @contextmanager
+    def _lock_project(self, project_name: str):
+        project_path = self._project_path(project_name)
+        if not os.path.isdir(project_path):
+            raise MVCError("Invalid project name.")
+        with ProjectLock(project_path):
+            recover(project_path)
+            yield self._get_project(project_name, locked=True)
+
+    def _commit(self, tr: Transaction, project: Project, project_path: str):
+        tr.save(project, project_path)
+        tr.commit()
+        self.catalog.update(project)
+
+    def _start_dev_cycle(self, project: Project, project_path: str):
+        # left over when a save was interrupted after its commit
+        if project.id.submit == 0:
+            shutil.rmtree(os.path.join(project_path, "temp"), ignore_errors=True)
+
     def _get_workspace(self):
         try:
             workspace = Workspace.load(self.user_path)
@@ -65,25 +313,39 @@ class MiniVC:
         except FileNotFoundError:
             return None
 
-    def __init__(self, base_path, user_path):
+    def __init__(self, base_path, user_path, workers: int = None, link: str = "auto"):
         self.base_path = base_path
         self.user_path = user_path
+        self.transfer = TransferEngine(workers)
+        self.catalog = Catalog(base_path)
         if not os.path.exists(base_path):
             raise MVCError("Invalid base path.")
+        if link not in LINK_MODES:
+            raise MVCError(f"Unknown link mode {link!r}, choose from {', '.join(LINK_MODES)}.")
+        self.link = link
 
-    def create(self, name: str):
-        if name == '': raise MVCError("Project must have a name.")
+    @trace.traced("create")
+    def create(self, name: str, chunking: bool = False, compression: str = ""):
+        self._create_project(name, chunking, compression)
+        workspace = Workspace(
+            name,)
+        workspace.save(self.user_path)
+
+    def _create_project(self, name: str, chunking: bool, compression: str):
+        project_path = self._project_path(name)
+        get_codec(compression)
         id = FileID(0,0,0)
         project = Project(
             name,
             id,
-            {})
-        project_path = os.path.join(self.base_path, name)
+            {},
+            chunking=chunking,
+            compression=compression,
+            layout=STORE_LAYOUT)
         try:
             os.makedirs(project_path)
         except OSError:
             raise MVCError("Trying to create project which already exists.")
-        project.save(project_path)
         version = Version(
             [f"## {id}",
              f"{name} was created",
@@ -91,50 +353,60 @@ class MiniVC:
             {})
         version_path = os.path.join(project_path, id.sub_path)
         os.makedirs(version_path, exist_ok=True)
-        version.save(version_path)
-        workspace = Workspace(
-            name,)
-        workspace.save(self.user_path)
+        with ProjectLock(project_path):
+            tr = Transaction(project_path)
+            tr.save(version, version_path)
+            self._commit(tr, project, project_path)
 
-    def submit(self, files: List[str], comment: str = ""):
-        workspace = self._get_workspace()
-        project, project_path = self._get_project(workspace.project)
+    def _stage_submit(self, tr: Transaction, project: Project, project_path: str,
+                      files: List[str], infos: dict[str, list], comment: str):
+        self._start_dev_cycle(project, project_path)
         version_path = os.path.join(project_path, project.id.sub_path)
-        version = Version.load(version_path)
-        work_files: list[str] = os.listdir(version_path)
-        work_files.remove('.mvc')
-        for file in work_files:
+        version = copy.deepcopy(tr.load(Version, version_path))
+        version.files, version.sizes = self._manifest(project_path, version, tr)
+        for file in version.blobs:
             version.include[file] = FileID.copy(project.id)
+        version.blobs = {}
         for file in files:
             version.include.pop(file, None)
         project.id.submit += 1
         version_path = os.path.join(project_path, project.id.sub_path)
         os.makedirs(version_path, exist_ok=True)
         for file_name in files:
-            src_path = os.path.join(self.user_path, file_name)
-            dst_path = os.path.join(version_path, file_name)
-            shutil.copy2(src_path, dst_path)
-            project.timestamps[file_name] = os.path.getmtime(src_path)
+            digest, size, mtime = infos[file_name]
+            version.blobs[file_name] = digest
+            version.files[file_name] = digest
+            version.sizes[file_name] = size
+            project.timestamps[file_name] = mtime
+            project.hashes[file_name] = digest
         version.description = [f"## {project.id}",
                                comment,
                                f"Submitted files:",
                                *[f' + {file}' for file in files],]
-        workspace.save(self.user_path)
-        version.save(version_path)
-        project.save(project_path)
+        tr.save(version, version_path)
+        submit = project.id.submit
+        tr.on_commit(lambda: self._append_dev_log(project_path, submit, version.description))
 
-    def remove(self, files: List[str], comment: str = ""):
-        workspace = self._get_workspace()
-        project, project_path = self._get_project(workspace.project)
+    def _stage_remove(self, tr: Transaction, project: Project, project_path: str,
+                      files: List[str], comment: str):
+        self._start_dev_cycle(project, project_path)
         version_path = os.path.join(project_path, project.id.sub_path)
-        version = Version.load(version_path)
-        work_files = os.listdir(version_path)
-        work_files.remove('.mvc')
-        for file in work_files:
+        version = copy.deepcopy(tr.load(Version, version_path))
+        version.files, version.sizes = self._manifest(project_path, version, tr)
+        for file in version.blobs:
             version.include[file] = FileID.copy(project.id)
+        version.blobs = {}
+        expanded = []
+        for path in files:
+            # a directory removes every tracked file below it
+            expanded += [f for f in version.include if is_under(f, path)] or [path]
+        files = list(dict.fromkeys(expanded))
         for file in files:
             version.include.pop(file, None)
+            version.files.pop(file, None)
+            version.sizes.pop(file, None)
             project.timestamps.pop(file, None)
+            project.hashes.pop(file, None)
         project.id.submit += 1
         version_path = os.path.join(project_path, project.id.sub_path)
         os.makedirs(version_path, exist_ok=True)
@@ -142,76 +414,336 @@ class MiniVC:
                                comment,
                                f"Removed files: ",
                                *[f' - {file}' for file in files],]
-        project.save(project_path)
-        version.save(version_path)
-        
-    def save(self, comment: str = ""):
-        workspace = self._get_workspace()
-        project, project_path = self._get_project(workspace.project)
+        tr.save(version, version_path)
+        submit = project.id.submit
+        tr.on_commit(lambda: self._append_dev_log(project_path, submit, version.description))
+
+    def _stage_save(self, tr: Transaction, project: Project, project_path: str, comment: str):
         if project.id.submit == 0:
             raise MVCError("No files submitted")
         submits_to_collect = project.id.submit
         dev_path = os.path.join(project_path, get_submit_path(submits_to_collect))
-        dev_version = Version.load(dev_path)
-        dev_files = list_files_dir(dev_path)
+        dev_version = tr.load(Version, dev_path)
+        dev_files = list(dev_version.blobs)
         stable_path = os.path.join(project_path, get_stable_path())
-        stable_version = Version.load(stable_path)
-        stable_files = list_files_dir(stable_path)
+        stable_version = copy.deepcopy(tr.load(Version, stable_path))
+        stable_files = list(stable_version.blobs)
         check_files = dev_files + [k for k in dev_version.include]
-        for file in check_files:
-            stable_version.include.pop(file, None)
+        stable_version.include = {}
         rm_files = [f for f in stable_files if f not in check_files]
         for file in rm_files:
-            os.remove(os.path.join(stable_path, file))
-        for file in dev_files:
-            src_path = os.path.join(dev_path, file)
-            shutil.copy2(src_path, stable_path)
+            stable_version.blobs.pop(file)
+        stable_version.blobs.update(dev_version.blobs)
+        submitted = {f: i for f, i in dev_version.include.items() if i.submit > 0}
+        stable_version.blobs.update(self._resolve_includes(project_path, submitted, tr))
         for file, file_id in dev_version.include.items():
-            src_path = os.path.join(project_path, file_id.sub_path, file)
-            if file_id.submit > 0:
-                shutil.copy2(src_path, stable_path)
-            elif file_id.save == 0 and file_id.release > 0:
+            if file_id.submit == 0 and file_id.save == 0 and file_id.release > 0:
+                stable_version.blobs.pop(file, None)
                 stable_version.include[file] = file_id
+        files, sizes = self._manifest(project_path, dev_version, tr)
+        stable_version.files, stable_version.sizes = dict(files), dict(sizes)
         project.id.save += 1
         project.id.submit = 0
         sub_description = [f"## {project.id}",
                            comment,]
-        for i in range(submits_to_collect, 0, -1):
-            sub_version_path = os.path.join(project_path, get_submit_path(i))
-            sub_version = Version.load(sub_version_path)
-            sub_description += sub_version.description
+        sub_description += self._get_dev_log(project_path, submits_to_collect, tr)
         stable_version.description = sub_description + stable_version.description
-        stable_version.save(stable_path)
+        tr.save(stable_version, stable_path)
         temp_path = os.path.join(project_path, "temp")
-        if os.path.exists(temp_path):
-            shutil.rmtree(temp_path)
-        project.save(project_path)
+        tr.on_commit(lambda: shutil.rmtree(temp_path, ignore_errors=True))
 
-    def release(self, comment: str = ""):
-        workspace = self._get_workspace()
-        project, project_path = self._get_project(workspace.project)
+    def _stage_release(self, tr: Transaction, project: Project, project_path: str, comment: str):
         if project.id.submit > 0:
             raise MVCError("Unsaved submits.")
         version_path = os.path.join(project_path, project.id.sub_path)
-        version = Version.load(version_path)
+        version = copy.deepcopy(tr.load(Version, version_path))
+        version.files, version.sizes = self._manifest(project_path, version, tr)
         project.id.release += 1
         project.id.save = 0
         description = [f"## {project.id}",
                        comment,]
         version.description = description + version.description
-        version.save(version_path)
-        next_version = Version([], {})
-        ref_files = os.listdir(version_path)
-        ref_files.remove(".mvc")
-        for file in ref_files:
-            next_version.include[file] = project.id
+        next_version = Version([], {}, files=dict(version.files), sizes=dict(version.sizes))
+        for file in version.blobs:
+            next_version.include[file] = FileID.copy(project.id)
+        release = project.id.release
         release_path = os.path.join(project_path, project.id.sub_path)
-        shutil.move(version_path, release_path)
-        os.makedirs(version_path)
-        next_version.save(version_path)
-        project.save(project_path)
+        os.makedirs(release_path, exist_ok=True)
+        tr.save(version, release_path)
+        tr.save(next_version, os.path.join(project_path, get_stable_path()))
+        def write_release_log():
+            previous = self._get_release_log(project_path, release - 1)
+            self._write_markdown(release_path, version.description + previous)
+        tr.on_commit(write_release_log)
 
-    def load(self, project_name: str, release: int = -1) -> FileOperation:
+    def _expand_files(self, files: List[str], stats: dict[str, os.stat_result]) -> List[str]:
+        """Normalized paths of files, with directories replaced by the files found below them."""
+        rules = None
+        expanded = []
+        for file in map(normalize_path, files):
+            if os.path.isdir(os.path.join(self.user_path, file)):
+                rules = rules or IgnoreRules.load(self.user_path)
+                found = scan_tree(self.user_path, file, rules)
+                stats.update(found)
+                expanded += found
+            else:
+                expanded.append(file)
+        return list(dict.fromkeys(expanded))
+
+    def _submitted(self, steps: List[dict]) -> dict[str, List[str]]:
+        submitted = {}
+        for step in steps:
+            if step["op"] == "submit":
+                submitted.setdefault(step["project"], set()).update(step["files"])
+        return {name: sorted(files) for name, files in submitted.items()}
+
+    def _store_files(self, submitted: dict[str, List[str]], infos: dict[str, list]):
+        """Put the content of workspace files, given per project, into the project stores."""
+        puts = []
+        for name, files in submitted.items():
+            project, project_path = self._get_project(name)
+            store = self._get_store(project_path, project.chunking, project.compression)
+            puts += [(store, file) for file in files]
+        self.transfer.run(
+            lambda item: item[0].put(os.path.join(self.user_path, item[1]), infos[item[1]][0]),
+            puts)
+
+    def _apply_batch(self, steps: List[dict], infos: dict[str, list]) -> dict[str, str]:
+        """Stage and commit steps under the project locks; infos holds [digest, size, mtime] of submitted files."""
+        names = sorted({step["project"] for step in steps})
+        with ExitStack() as stack, trace.span("batch.metadata", steps=len(steps)):
+            locked = {name: stack.enter_context(self._lock_project(name)) for name in names}
+            submitted = self._submitted(steps)
+            if submitted:
+                # a gc that ran before the locks were taken may have swept objects stored before
+                self._store_files(submitted, infos)
+            transactions = {name: Transaction(locked[name][1]) for name in names}
+            saved = set()
+            for step in steps:
+                name = step["project"]
+                project, project_path = locked[name]
+                tr = transactions[name]
+                op = step["op"]
+                comment = step.get("comment", "")
+                if name in saved and op in ("submit", "remove"):
+                    # the save must be committed before a new development cycle starts
+                    self._commit(tr, project, project_path)
+                    saved.discard(name)
+                if op == "submit":
+                    self._stage_submit(tr, project, project_path, step["files"], infos, comment)
+                elif op == "remove":
+                    self._stage_remove(tr, project, project_path, step["files"], comment)
+                elif op == "save":
+                    self._stage_save(tr, project, project_path, comment)
+                    saved.add(name)
+                else:
+                    self._stage_release(tr, project, project_path, comment)
+            for name in names:
+                self._commit(transactions[name], *locked[name])
+        return {name: str(locked[name][0].id) for name in names}
+
+    def _check_step(self, i: int, step: dict):
+        if not isinstance(step, dict):
+            raise MVCError(f"Batch step {i} is not an object.")
+        if step.get("op") not in ("submit", "remove", "save", "release"):
+            raise MVCError(f"Batch step {i} has an invalid operation {step.get('op')!r}.")
+        if not isinstance(step.get("project", ""), (str, type(None))):
+            raise MVCError(f"Batch step {i} has a project that is not a string.")
+        if not isinstance(step.get("comment", ""), str):
+            raise MVCError(f"Batch step {i} has a comment that is not a string.")
+        if step["op"] in ("submit", "remove"):
+            files = step.get("files")
+            if not isinstance(files, list) or not all(isinstance(f, str) for f in files):
+                raise MVCError(f"Batch step {i} needs files as a list of strings.")
+
+    @trace.traced("batch")
+    def batch(self, steps: List[dict]) -> dict[str, str]:
+        """Run submit, remove, save and release steps with one metadata transaction per project.
+
+        Each step is a dict with an "op", an optional "project" (defaults to the
+        workspace project), the "files" of a submit or remove and a "comment".
+        Files are paths relative to the workspace; a directory submits the files
+        below it that are not ignored by .mvcignore, or removes the tracked ones.
+        Returns the resulting version id of every project involved.
+        """
+        workspace = self._get_workspace()
+        stats = {}
+        if not isinstance(steps, list):
+            raise MVCError("Batch steps must be a list.")
+        for i, step in enumerate(steps):
+            self._check_step(i, step)
+        steps = [dict(step) for step in steps]
+        for step in steps:
+            step["project"] = step.get("project") or (workspace.project if workspace else None)
+            if step["project"] is None:
+                raise MVCError("No project given and no project loaded in the workspace.")
+            if step["op"] == "submit":
+                step["files"] = self._expand_files(step["files"], stats)
+            elif step["op"] == "remove":
+                step["files"] = [normalize_path(f) for f in step["files"]]
+
+        submitted = self._submitted(steps)
+        files = sorted(set().union(*submitted.values()))
+        for file in files:
+            if file not in stats:
+                try:
+                    stats[file] = os.stat(os.path.join(self.user_path, file))
+                except FileNotFoundError:
+                    if workspace is not None and file in workspace.lazy:
+                        raise MVCError(f"{file} was loaded lazily and has not been fetched, "
+                                       f"run 'mvc fetch {file}' first.") from None
+                    raise MVCError(f"{file} does not exist in the workspace.") from None
+        index = WorkspaceIndex(self.user_path, self.transfer.workers)
+        hashes = index.hashes(files, stats)
+        infos = {file: [hashes[file], stats[file].st_size, stats[file].st_mtime] for file in files}
+        # file contents go to the stores before any project is locked
+        with trace.span("batch.store", files=len(files)):
+            self._store_files(submitted, infos)
+        ids = self._apply_batch(steps, infos)
+
+        if workspace is not None:
+            for step in steps:
+                if step["project"] != workspace.project:
+                    continue
+                for file in step.get("files", []):
+                    if step["op"] == "submit":
+                        workspace.files[file] = hashes[file]
+                    elif step["op"] == "remove":
+                        for tracked in [f for f in workspace.files if is_under(f, file)]:
+                            workspace.files.pop(tracked)
+                        for deferred in [f for f in workspace.lazy if is_under(f, file)]:
+                            workspace.lazy.pop(deferred)
+            workspace.save(self.user_path)
+        index.save()
+        return ids
+
+    @trace.traced("submit")
+    def submit(self, files: List[str], comment: str = ""):
+        self.batch([{"op": "submit", "files": files, "comment": comment}])
+
+    @trace.traced("remove")
+    def remove(self, files: List[str], comment: str = ""):
+        self.batch([{"op": "remove", "files": files, "comment": comment}])
+        
+    @trace.traced("save")
+    def save(self, comment: str = ""):
+        self.batch([{"op": "save", "comment": comment}])
+
+    @trace.traced("release")
+    def release(self, comment: str = ""):
+        self.batch([{"op": "release", "comment": comment}])
+
+    def _pack_releases(self, project: Project, project_path: str, keep: int) -> int:
+        digests = set()
+        for i in range(1, project.id.release - keep + 1):
+            version = Version.load(os.path.join(project_path, get_release_path(i)))
+            digests.update(version.blobs.values())
+        return self._get_store(project_path).pack_objects(digests)
+
+    @trace.traced("unlock")
+    def unlock(self, project_name: str) -> dict:
+        """Break the lock of a project left by a process that is gone, returning its owner as recorded."""
+        project_path = self._project_path(project_name)
+        if not os.path.isdir(project_path):
+            raise MVCError("Invalid project name.")
+        return ProjectLock(project_path).break_lock()
+
+    @trace.traced("pack")
+    def pack(self, project_name: str, keep: int = 1) -> int:
+        with self._lock_project(project_name) as (project, project_path):
+            return self._pack_releases(project, project_path, keep)
+
+    def _stray_paths(self, project: Project, project_path: str) -> List[str]:
+        """Metadata directories of interrupted or abandoned submits and releases."""
+        stray = []
+        live = {os.path.basename(get_submit_path(i)) for i in range(1, project.id.submit + 1)}
+        live.add(os.path.basename(get_dev_log_path()))
+        temp_path = os.path.dirname(get_submit_path(1))
+        if project.id.submit == 0 and os.path.isdir(os.path.join(project_path, temp_path)):
+            stray.append(temp_path)
+        elif project.id.submit > 0:
+            stray += [os.path.join(temp_path, name) for name in os.listdir(os.path.join(project_path, temp_path))
+                      if name not in live]
+        live = {os.path.basename(get_release_path(i)) for i in range(1, project.id.release + 1)}
+        live.add(os.path.basename(get_stable_path()))
+        versions_path = os.path.dirname(get_stable_path())
+        stray += [os.path.join(versions_path, name) for name in os.listdir(os.path.join(project_path, versions_path))
+                  if name not in live]
+        return stray
+
+    def _live_digests(self, project: Project, project_path: str) -> set[str]:
+        """Digests of the files of every version of a project."""
+        digests = set()
+        live = [get_stable_path()]
+        live += [get_release_path(i) for i in range(1, project.id.release + 1)]
+        live += [get_submit_path(i) for i in range(1, project.id.submit + 1)]
+        for sub_path in live:
+            digests.update(Version.load(os.path.join(project_path, sub_path)).blobs.values())
+        return digests
+
+    @trace.traced("verify")
+    def verify(self, project_name: str = None, memory: int = 64 << 20) -> List[VerifyReport]:
+        """Check that the objects of every version of a project, or of all projects, match their digests.
+
+        Objects are streamed in blocks, each reader holding about four blocks,
+        so at most memory // (4 * BLOCK_SIZE) readers run at once.
+        """
+        names = [project_name] if project_name else list(self.list_projects())
+        items = []
+        for name in names:
+            project, project_path = self._get_project(name)
+            store = self._get_store(project_path)
+            items += [(name, store, digest) for digest in sorted(self._live_digests(project, project_path))]
+        engine = TransferEngine(min(self.transfer.workers, max(1, memory // (4 * BLOCK_SIZE))))
+        results = engine.run(lambda item: item[1].check(item[2]), items)
+        reports = {name: VerifyReport(name, 0, 0, [], []) for name in names}
+        for (name, _, digest), (state, size) in zip(items, results):
+            report = reports[name]
+            report.objects += 1
+            report.size += size
+            if state == "corrupt":
+                report.corrupt.append(digest)
+            elif state == "missing":
+                report.missing.append(digest)
+        for report in reports.values():
+            if report.missing:
+                # a gc or pack running meanwhile may have moved or dropped them
+                with self._lock_project(report.project_name) as (project, project_path):
+                    live = self._live_digests(project, project_path)
+                    store = self._get_store(project_path)
+                    report.missing = [d for d in report.missing if d in live and not store.has(d)]
+        return list(reports.values())
+
+    @trace.traced("gc")
+    def gc(self, project_name: str, keep: int = None, dry_run: bool = False, grace: float = 3600) -> GarbageReport:
+        """Delete the storage of a project that no version can reach.
+
+        With keep, the objects of all but the last keep releases are packed
+        first. Temporary files younger than grace seconds are left alone.
+        """
+        with self._lock_project(project_name) as (project, project_path):
+            paths = self._stray_paths(project, project_path)
+            size = 0
+            for path in paths:
+                for root, _, files in os.walk(os.path.join(project_path, path)):
+                    size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+            if keep is not None and not dry_run:
+                self._pack_releases(project, project_path, keep)
+            store = self._get_store(project_path)
+            loose, packed, store_size = store.sweep(self._live_digests(project, project_path), grace, dry_run)
+            if not dry_run:
+                for path in paths:
+                    shutil.rmtree(os.path.join(project_path, path), ignore_errors=True)
+            paths += [os.path.join(get_objects_path(), path) for path in loose]
+            return GarbageReport(project_name, paths, packed, size + store_size)
+
+    @trace.traced("load")
+    def load(self, project_name: str, release: int = -1, include: List[str] = None,
+             exclude: List[str] = None, lazy: bool = False) -> FileOperation:
+        return self._sync_operation(project_name, *self._load_plan(project_name, release), include, exclude, lazy)
+
+    def _load_plan(self, project_name: str, release: int) -> tuple[List[str], dict[str, str]]:
+        """History and files of a version."""
         project, project_path = self._get_project(project_name)
         if release > 0:
             project.id = FileID(release, 0, 0)
@@ -221,68 +753,141 @@ class MiniVC:
             version_path = os.path.join(project_path, project.id.sub_path)
         if not os.path.exists(version_path):
             raise MVCError("Invalid version")
-        version = Version.load(version_path)
-        version_files = list_files_dir(version_path)
-        files_to_add = {}
-        for file in version_files:
-            files_to_add[file] = version_path
-        for file, file_id in version.include.items():
-            if file_id.release > 0:
-                include_path = os.path.join(project_path, file_id.sub_path)
-                files_to_add[file] = include_path
-        return FileOperation(
-            project_name,
-            self._get_history_markdown(project),
-            files_to_add,
-            [])
+        version_files = self._manifest_files(project_path, Version.load(version_path))
+        return self._get_history_markdown(project), version_files
     
+    @trace.traced("load_finalize")
     def load_finalize(self, recipe: FileOperation):
         self._execute(recipe)
         self._write_markdown(self.user_path, recipe.md)
-        Workspace(recipe.project_name).save(self.user_path)
 
-    def review(self) -> FileOperation:
+    @trace.traced("review")
+    def review(self, include: List[str] = None, exclude: List[str] = None, lazy: bool = False) -> FileOperation:
         workspace = self._get_workspace()
-        project, project_path = self._get_project(workspace.project)
+        return self._sync_operation(workspace.project, *self._review_plan(workspace.project), include, exclude, lazy)
+
+    def _review_plan(self, project_name: str) -> tuple[List[str], dict[str, str]]:
+        project, project_path = self._get_project(project_name)
         if project.id.submit == 0:
             raise MVCError("No files submitted")
         dev_path = os.path.join(project_path, get_submit_path(project.id.submit))
-        dev = Version.load(dev_path)
-        dev_files = list_files_dir(dev_path)
-        files_to_add = {}
-        for file in dev_files:
-            files_to_add[file] = dev_path
-        for file, file_id in dev.include.items():
-            file_path = os.path.join(project_path, file_id.sub_path)
-            files_to_add[file] = file_path
-        return FileOperation(
-            project.name,
-            self._get_history_markdown(project),
-            files_to_add,
-            [])
+        version_files = self._manifest_files(project_path, Version.load(dev_path))
+        return self._get_history_markdown(project), version_files
     
+    @trace.traced("review_finalize")
     def review_finalize(self, recipe: FileOperation):
         self._execute(recipe)
         self._write_markdown(self.user_path, recipe.md)
 
-    def list_projects(self) -> dict[str, str]:
-        projects_paths = os.listdir(self.base_path)
-        ret = {}
-        for path in projects_paths:
-            project = Project.load(os.path.join(self.base_path, path))
-            ret[project.name] = str(project.id)
-        return ret
+    @trace.traced("fetch")
+    def fetch(self, patterns: List[str] = None) -> List[str]:
+        """Write the lazily loaded files matching patterns, or all of them, into the workspace."""
+        workspace = self._get_workspace()
+        if workspace is None:
+            raise MVCError("No project loaded in the workspace.")
+        files = select_paths(sorted(workspace.lazy), patterns)
+        fetched = {f: workspace.lazy[f] for f in files}
+        self._export_files(workspace.project, fetched)
+        index = WorkspaceIndex(self.user_path, self.transfer.workers)
+        index.record(fetched)
+        index.save()
+        for file in files:
+            workspace.files[file] = workspace.lazy.pop(file)
+        workspace.save(self.user_path)
+        return files
+
+    def _file_digest(self, project_name: str, path: str, version="latest") -> str:
+        """Digest of one file of a version, from its manifest or, for versions without one, its include."""
+        project, project_path = self._get_project(project_name)
+        file = normalize_path(path)
+        found = Version.load(self._version_path(project, project_path, version))
+        if file in found.files:
+            return found.files[file]
+        if not found.files and file in found.blobs:
+            return found.blobs[file]
+        if not found.files and file in found.include:
+            return self._resolve_includes(project_path, {file: found.include[file]})[file]
+        raise MVCError(f"{file} is not in version {version}.")
+
+    @trace.traced("open")
+    def open(self, project_name: str, path: str, version="latest"):
+        """Binary stream of one file of a version, read from the store without a checkout.
+
+        Versions are release numbers, "latest" for the saved version or "dev"
+        for the last submit.
+        """
+        digest = self._file_digest(project_name, path, version)
+        return self._get_store(self._project_path(project_name)).open(digest)
+
+    @trace.traced("diff")
+    def diff(self, project_name: str, a="latest", b="dev") -> FileDiff:
+        """Files added, removed and modified from version a to version b, compared by manifest only.
 
+        Versions are release numbers, "latest" for the saved version or "dev"
+        for the last submit.
+        """
+        project, project_path = self._get_project(project_name)
+        old = self._manifest_files(project_path, Version.load(self._version_path(project, project_path, a)))
+        new = self._manifest_files(project_path, Version.load(self._version_path(project, project_path, b)))
+        return FileDiff(
+            sorted(f for f in new if f not in old),
+            sorted(f for f in old if f not in new),
+            sorted(f for f in new if f in old and new[f] != old[f]))
+
+    def _run_on_project(self, project_name: str, operation: str, args: tuple):
+        if operation in ("save", "release"):
+            # no workspace is involved, so the steps go straight to the project
+            step = {"op": operation, "project": project_name, "comment": args[0] if args else ""}
+            return self._apply_batch([step], {})[project_name]
+        if operation == "status":
+            return self._status(project_name)
+        if operation == "contents":
+            return self._contents(project_name)
+        if operation == "verify":
+            return self.verify(project_name, *args)[0]
+        return getattr(self, operation)(project_name, *args)
+
+    @trace.traced("each")
+    def each(self, projects: List[str], operation: str, *args, concurrency: int = 4) -> List[ProjectResult]:
+        """Run an operation of EACH_OPERATIONS on many projects, at most concurrency at a time.
+
+        args follow the project name as in the single project method; save
+        and release take a comment. The result or error of every project is
+        collected instead of raised, in the order of projects.
+        """
+        if operation not in EACH_OPERATIONS:
+            raise MVCError(f"Unknown operation {operation!r}, choose from {', '.join(EACH_OPERATIONS)}.")
+        def run(name):
+            try:
+                return ProjectResult(name, self._run_on_project(name, operation, args))
+            except MVCError as e:
+                return ProjectResult(name, error=str(e))
+            except Exception as e:
+                return ProjectResult(name, error=f"{type(e).__name__}: {e}")
+        if len(projects) < 2 or concurrency <= 1:
+            return [run(name) for name in projects]
+        with ThreadPoolExecutor(min(concurrency, len(projects))) as pool:
+            return list(pool.map(trace.bind(run), projects))
+
+    @trace.traced("list_projects")
+    def list_projects(self, prefix: str = "", offset: int = 0, limit: int = None,
+                      min_release: int = None, pending: bool = None) -> dict[str, str]:
+        if not self.catalog.exists():
+            self.catalog.rebuild()
+        return self.catalog.query(prefix, offset, limit, min_release, pending)
+
+    @trace.traced("rebuild_catalog")
+    def rebuild_catalog(self) -> int:
+        return self.catalog.rebuild()
+
+    @trace.traced("status")
     def status(self) -> List[str]:
-        workspace = self._get_workspace()
-        project, project_path = self._get_project(workspace.project)
+        return self._status(self._get_workspace().project)
+
+    def _status(self, project_name: str) -> List[str]:
+        project, project_path = self._get_project(project_name)
         if project.id.submit > 0:
-            ret = []
-            for i in range(project.id.submit, 0, -1):
-                version_path = os.path.join(project_path, get_submit_path(i))
-                version = Version.load(version_path)
-                ret += version.description
-            return ret
+            return self._get_dev_log(project_path, project.id.submit)
         elif project.id.release > 0 and project.id.save == 0: 
             sub_path = get_release_path(project.id.release)
         else:
@@ -291,20 +896,33 @@ class MiniVC:
         version = Version.load(version_path)
         return version.description
     
+    @trace.traced("contents")
     def contents(self) -> List[str]:
-        workspace = self._get_workspace()
-        project, project_path = self._get_project(workspace.project)
+        return self._contents(self._get_workspace().project)
+
+    def _contents(self, project_name: str) -> List[str]:
+        project, project_path = self._get_project(project_name)
         dev_path = os.path.join(project_path, project.id.sub_path)
         dev_version = Version.load(dev_path)
-        dev_files = list_files_dir(dev_path)
-        return dev_files + [k for k in dev_version.include]
+        return list(dev_version.blobs) + [k for k in dev_version.include]
 
+    @trace.traced("changes")
     def changes(self) -> List[str]:
         workspace = self._get_workspace()
         project, _ = self._get_project(workspace.project)
-        workspace_files = list_files_dir(self.user_path)
+        stats = scan_tree(self.user_path)
+        workspace_files = list(stats)
+        index = WorkspaceIndex(self.user_path, self.transfer.workers)
+        hashes = index.hashes(workspace_files, stats)
+        index.prune(workspace_files)
+        index.save()
         changed_files = []
         for file in workspace_files:
+            if file in project.hashes:
+                if project.hashes[file] != hashes[file]:
+                    changed_files.append(file)
+                continue
+            # projects submitted before content hashing only have timestamps
             fpath = os.path.join(self.user_path, file)
             stamp = os.path.getmtime(fpath)
             file_is_new = file not in project.timestamps
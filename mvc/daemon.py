@@ -0,0 +1,149 @@
+import io
+import os
+import sys
+import json
+import stat
+import struct
+import signal
+import socket
+import hashlib
+import tempfile
+import traceback
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+
+from mvc.helpers import MVCError, JSONBase, MetadataCache
+
+SOCKET_FILE = ".mvc-daemon.sock"
+
+def _runtime_dir() -> str:
+    """A directory only the current user can enter: $XDG_RUNTIME_DIR, or a 0700 directory in the temp dir."""
+    runtime = os.getenv("XDG_RUNTIME_DIR")
+    if runtime or not hasattr(os, "getuid"):
+        return runtime or tempfile.gettempdir()
+    path = os.path.join(tempfile.gettempdir(), f"mvc-{os.getuid()}")
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise MVCError(f"{path} is not a private directory of the current user.")
+    return path
+
+def get_socket_path(base_path: str) -> str:
+    """MINIVC_SOCKET, or a socket named after the base path in the runtime directory of the user."""
+    if os.getenv("MINIVC_SOCKET"):
+        return os.getenv("MINIVC_SOCKET")
+    key = hashlib.sha256(os.path.abspath(base_path).encode()).hexdigest()[:16]
+    return os.path.join(_runtime_dir(), f"mvc-daemon-{key}.sock")
+
+def _peer_uid(sock) -> int:
+    """User id of the process at the other end of a Unix socket, or None where the platform cannot tell."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+def _connect(socket_path: str):
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def forward(socket_path: str, argv: list[str], cwd: str):
+    """Run a CLI command in a running daemon and return its exit code, or None if no daemon is listening."""
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    with sock:
+        sock.sendall(json.dumps({"argv": argv, "cwd": cwd}).encode())
+        sock.shutdown(socket.SHUT_WR)
+        data = b"".join(iter(lambda: sock.recv(65536), b""))
+    try:
+        reply = json.loads(data)
+    except ValueError:
+        raise MVCError("Lost connection to the daemon.")
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    return reply["code"]
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.read())
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                code = self.server.command(request["argv"], request["cwd"])
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+        reply = {"stdout": out.getvalue(), "stderr": err.getvalue(), "code": code or 0}
+        self.wfile.write(json.dumps(reply).encode())
+
+class Daemon(socketserver.UnixStreamServer):
+    """Runs CLI commands sent over a Unix socket in one long-lived process.
+
+    command(argv, cwd) is called for every request with its output captured.
+    Requests are handled one at a time, and metadata files stay decoded in a
+    MetadataCache between them.
+
+    Commands run with the rights of the daemon's user, so the socket is
+    created with mode 0600, by default in a directory private to that user,
+    and connections from processes of other users are refused.
+    """
+
+    def __init__(self, socket_path: str, command):
+        self.command = command
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            sock = _connect(socket_path)
+            if sock is not None:
+                sock.close()
+                raise MVCError("A daemon is already running.")
+            os.remove(socket_path)
+        super().__init__(socket_path, _Handler)
+
+    def server_bind(self):
+        previous = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(previous)
+        os.chmod(self.socket_path, 0o600)
+
+    def verify_request(self, request, client_address) -> bool:
+        uid = _peer_uid(request)
+        return uid is None or uid == os.getuid()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(socket_path: str, command):
+    """Serve commands until interrupted or terminated, then remove the socket."""
+    signal.signal(signal.SIGTERM, _interrupt)
+    previous = JSONBase.cache
+    JSONBase.cache = MetadataCache()
+    try:
+        with Daemon(socket_path, command) as daemon:
+            print(f"mvc daemon listening on {socket_path}")
+            try:
+                daemon.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        JSONBase.cache = previous
@@ -1,16 +1,68 @@
 import os
+import re
+import copy
 import shutil
-import json
-from dataclasses import dataclass, asdict
+import threading
+from dataclasses import dataclass, field
+
+from mvc import trace
 # ================================================================= #
 # ------------------------  Error classes -------------------------- #
 class MVCError(Exception):
     def __init__(self, message):
         super().__init__(message)
 
+class TransferError(MVCError):
+    def __init__(self, errors: list):
+        self.errors = errors
+        lines = [f"  {item}: {error}" for item, error in errors]
+        super().__init__(f"{len(errors)} file operation(s) failed:\n" + "\n".join(lines))
+
+class IntegrityError(MVCError):
+    pass
+
 # ================================================================= #
 # ---------------------------- Functions -------------------------- #
 
+# size of the blocks files are read, copied and hashed in
+BLOCK_SIZE = 1 << 20
+
+# project operations MiniVC.each runs
+EACH_OPERATIONS = ("save", "release", "status", "contents", "pack", "gc", "verify")
+
+# layout of projects keeping file contents in the blob store; older projects
+# hold loose copies in their version directories
+STORE_LAYOUT = 1
+
+def check_project_name(name) -> str:
+    """Refuse names that would resolve outside their own directory of the base path."""
+    if not isinstance(name, str) or name == '':
+        raise MVCError("Project must have a name.")
+    separators = {"/", os.sep, os.altsep} - {None}
+    if (name.startswith(".") or os.path.isabs(name) or os.path.splitdrive(name)[0]
+            or "\0" in name or any(sep in name for sep in separators)):
+        raise MVCError(f"Invalid project name {name!r}.")
+    return name
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+def is_digest(value) -> bool:
+    """Whether value is a SHA-256 digest as objects are named: 64 lowercase hex characters."""
+    return isinstance(value, str) and _DIGEST.fullmatch(value) is not None
+
+def check_digests(digests) -> list:
+    """Refuse anything but a list of digests, which would otherwise name paths of the store."""
+    if not isinstance(digests, list):
+        raise MVCError("Digests must be a list.")
+    for digest in digests:
+        if not is_digest(digest):
+            raise MVCError(f"Invalid digest {digest!r}.")
+    return digests
+
+def get_tmp_path(path: str) -> str:
+    """A name next to path, unique per process and thread, to write a file before it replaces path."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
 def get_submit_path(submit_id: int) -> str:
     return os.path.join("temp", f"sub{submit_id}")
 
@@ -20,8 +72,14 @@ def get_stable_path() -> str:
 def get_release_path(release_id: int) -> str:
     return os.path.join("versions", f"ver{release_id}")
 
-def list_files_dir(dir: str):
-    return [f for f in os.listdir(dir) if f not in (".mvc", "changelog.md")]
+def get_dev_log_path() -> str:
+    return os.path.join("temp", "changelog")
+
+def get_objects_path() -> str:
+    return "objects"
+
+def get_packs_path() -> str:
+    return "packs"
 
 # ================================================================= #
 # ------------------------  Data classes -------------------------- #
@@ -53,40 +111,148 @@ class FileOperation:
     md: list[str]
     files_to_add: dict[str,str]
     files_to_remove: list[str]
+    version_files: dict[str,str] = field(default_factory=dict)
+    # version files left out of the checkout until fetched
+    lazy: dict[str,str] = field(default_factory=dict)
+    include: list[str] = field(default_factory=list)
+    exclude: list[str] = field(default_factory=list)
+
+@dataclass
+class GarbageReport:
+    project_name: str
+    paths: list[str]
+    packed: list[str]
+    size: int
+
+@dataclass
+class ProjectResult:
+    project_name: str
+    result: object = None
+    error: str = None
+
+@dataclass
+class VerifyReport:
+    project_name: str
+    objects: int
+    size: int
+    corrupt: list[str]
+    missing: list[str]
 # ================================================================= #
 # ------------------ Persistent Data classes ---------------------- #
 
+class MetadataCache:
+    """Decoded metadata files, reused while the file on disk is unchanged.
+
+    Entries are keyed by the (mtime_ns, size, inode) of the open file. Metadata
+    is always replaced by rename, so every save gives the file a new inode.
+    Callers get a copy they are free to modify.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def load(self, cls, f):
+        from mvc import serial
+        st = os.fstat(f.fileno())
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        filename = os.path.abspath(f.name)
+        with self._lock:
+            entry = self.entries.get(filename)
+        if entry is not None and entry[0] == key and entry[1] is cls:
+            trace.count("metadata_cache_hits")
+            return copy.deepcopy(entry[2])
+        data = f.read()
+        trace.count("metadata_reads")
+        trace.count("metadata_bytes_read", len(data))
+        obj = serial.loads(cls, data)
+        lazy = obj.__dict__.get("_lazy")
+        if lazy is not None:
+            for name in list(lazy.sections):
+                getattr(obj, name)
+            del obj.__dict__["_lazy"]
+        with self._lock:
+            self.entries[filename] = (key, cls, obj)
+        return copy.deepcopy(obj)
+
+
 class JSONBase:
-    """Base class providing JSON persistence for dataclasses."""
+    """Base class providing persistence for dataclasses.
+
+    Files are written in metadata_format ("binary" or "json") and read in
+    either, so JSON files from older versions are migrated on their next save.
+    """
+    metadata_format = os.getenv("MINIVC_METADATA_FORMAT", "binary")
+    cache: MetadataCache = None
+
+    def __getattr__(self, name):
+        lazy = self.__dict__.get("_lazy")
+        if lazy is None or name not in lazy.sections:
+            raise AttributeError(name)
+        value = lazy.decode(name)
+        setattr(self, name, value)
+        return value
+
+    def write(self, filename: str):
+        from mvc import serial
+        with trace.span("metadata.write", type=type(self).__name__):
+            data = serial.dumps(self, self.metadata_format)
+            with open(filename, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        trace.count("metadata_writes")
+        trace.count("metadata_bytes_written", len(data))
 
     def save(self, filedir: str):
         filename = os.path.join(filedir, ".mvc")
-        data = asdict(self)
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
+        tmp_path = get_tmp_path(filename)
+        self.write(tmp_path)
+        os.replace(tmp_path, filename)
 
     @classmethod
     def load(cls, filedir: str):
-        def object_hook(d: dict):
-            if all(field in d for field in FileID.__annotations__):
-                return FileID(**d)
-            return d
+        from mvc import serial
         filename = os.path.join(filedir, ".mvc")
-        with open(filename, 'r') as f:
-            data = json.load(f, object_hook=object_hook)
-        return cls(**data)
+        with trace.span("metadata.read", type=cls.__name__):
+            with open(filename, 'rb') as f:
+                if cls.cache is not None:
+                    return cls.cache.load(cls, f)
+                data = f.read()
+            trace.count("metadata_reads")
+            trace.count("metadata_bytes_read", len(data))
+            return serial.loads(cls, data)
 
 @dataclass
 class Project(JSONBase):
     name: str
     id: FileID
     timestamps: dict[str, str]
+    hashes: dict[str, str] = field(default_factory=dict)
+    chunking: bool = False
+    compression: str = ""
+    layout: int = 0
 
 @dataclass
 class Workspace(JSONBase):
     project: str
+    files: dict[str, str] = field(default_factory=dict)
+    # files of the loaded version not fetched yet, and the sparse checkout patterns
+    lazy: dict[str, str] = field(default_factory=dict)
+    include: list[str] = field(default_factory=list)
+    exclude: list[str] = field(default_factory=list)
+
+@dataclass
+class FileDiff:
+    added: list[str]
+    removed: list[str]
+    modified: list[str]
 
 @dataclass
 class Version(JSONBase):
     description: list[str]
     include: dict[str, FileID]
+    blobs: dict[str, str] = field(default_factory=dict)
+    # manifest of every file in the version, including the ones in include
+    files: dict[str, str] = field(default_factory=dict)
+    sizes: dict[str, int] = field(default_factory=dict)
@@ -0,0 +1,75 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from mvc import trace
+from mvc.helpers import get_tmp_path
+from mvc.store import hash_file
+
+INDEX_FILE = ".mvcindex"
+
+class WorkspaceIndex:
+    """Content hashes of workspace files, cached by (size, mtime_ns, inode).
+
+    Files whose stat tuple matches the cached one are not read again. An entry
+    is only trusted if the file's mtime is older than the mtime of the index
+    file itself, both stamped by the same filesystem clock. A file modified in
+    the same timestamp tick as the index was written is racy: it could change
+    again without changing its stat tuple, so it is hashed again.
+    """
+
+    def __init__(self, user_path: str, workers: int = None):
+        self.user_path = user_path
+        self.workers = workers
+        self.written = 0
+        self.entries: dict[str, list] = {}
+        try:
+            with open(os.path.join(user_path, INDEX_FILE), 'r') as f:
+                self.written = os.fstat(f.fileno()).st_mtime_ns
+                self.entries = json.load(f)["entries"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    @trace.traced("index.hashes")
+    def hashes(self, files: list[str], stats: dict[str, os.stat_result] = None) -> dict[str, str]:
+        """Content hashes of files, using the stat results in stats where given."""
+        ret = {}
+        stale = []
+        stats = stats or {}
+        for file in files:
+            st = stats.get(file) or os.stat(os.path.join(self.user_path, file))
+            key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = self.entries.get(file)
+            if entry is not None and entry[:3] == key and key[1] < self.written:
+                ret[file] = entry[3]
+            else:
+                stale.append((file, key))
+        trace.count("index_hits", len(ret))
+        trace.count("index_misses", len(stale))
+        paths = [os.path.join(self.user_path, file) for file, _ in stale]
+        if len(paths) > 1:
+            with ThreadPoolExecutor(self.workers) as pool:
+                digests = list(pool.map(trace.bind(hash_file), paths))
+        else:
+            digests = [hash_file(path) for path in paths]
+        for (file, key), digest in zip(stale, digests):
+            self.entries[file] = key + [digest]
+            ret[file] = digest
+        return ret
+
+    def record(self, files: dict[str, str]):
+        """Enter the known digests of files just written, so they are not read again."""
+        for file, digest in files.items():
+            st = os.stat(os.path.join(self.user_path, file))
+            self.entries[file] = [st.st_size, st.st_mtime_ns, st.st_ino, digest]
+
+    def prune(self, files: list[str]):
+        keep = set(files)
+        self.entries = {f: e for f, e in self.entries.items() if f in keep}
+
+    def save(self):
+        filename = os.path.join(self.user_path, INDEX_FILE)
+        tmp_path = get_tmp_path(filename)
+        with open(tmp_path, 'w') as f:
+            json.dump({"entries": self.entries}, f)
+        os.replace(tmp_path, filename)
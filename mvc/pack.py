@@ -0,0 +1,180 @@
+import io
+import os
+import mmap
+import shutil
+import struct
+
+from mvc import trace
+from mvc.helpers import MVCError, BLOCK_SIZE, get_tmp_path
+
+PACK_FILE = "pack.dat"
+INDEX_FILE = "pack.idx"
+INDEX_MAGIC = b"MVCIDX2\0"
+INDEX_MAGIC_V1 = b"MVCIDX1\0"
+
+KIND_BLOB = 0
+KIND_CHUNKS = 1
+
+_HEADER_V1 = struct.Struct(">8sQ")
+_HEADER = struct.Struct(">8sQQ")
+_ENTRY = struct.Struct(">32sQQB")
+
+class MemoryReader(io.RawIOBase):
+    """Read-only stream over a memoryview, without copying the underlying buffer."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+class _StaleIndex(Exception):
+    pass
+
+class Pack:
+    """A project's pack file, located through a sorted, memory-mapped index.
+
+    The index holds fixed-size (digest, offset, length, kind) records sorted by
+    digest, so a lookup is a binary search over the mapped file. It also records
+    the size of the data it describes: a data file shorter than that has been
+    rewritten since the index was read, and the pair is opened again.
+    """
+
+    def __init__(self, pack_path: str):
+        self.pack_path = pack_path
+        with open(os.path.join(pack_path, INDEX_FILE), 'rb') as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self._index[:len(INDEX_MAGIC)]
+        if magic == INDEX_MAGIC:
+            _, self.count, self.data_size = _HEADER.unpack_from(self._index, 0)
+            self._entries_offset = _HEADER.size
+        elif magic == INDEX_MAGIC_V1:
+            _, self.count = _HEADER_V1.unpack_from(self._index, 0)
+            self.data_size = 0
+            self._entries_offset = _HEADER_V1.size
+        else:
+            raise MVCError("Invalid pack index.")
+        self._data = None
+        with open(os.path.join(pack_path, PACK_FILE), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.data_size:
+                raise _StaleIndex()
+            if size > 0:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def open(cls, pack_path: str):
+        for _ in range(100):
+            if not os.path.exists(os.path.join(pack_path, INDEX_FILE)):
+                return None
+            try:
+                return cls(pack_path)
+            except _StaleIndex:
+                continue
+        raise MVCError("Pack index does not match the pack file.")
+
+    def _entry(self, i: int):
+        return _ENTRY.unpack_from(self._index, self._entries_offset + i * _ENTRY.size)
+
+    def entries(self):
+        for i in range(self.count):
+            key, offset, length, kind = self._entry(i)
+            yield key.hex(), offset, length, kind
+
+    def lookup(self, digest: str):
+        key = bytes.fromhex(digest)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if entry[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            entry = self._entry(lo)
+            if entry[0] == key:
+                return entry[1:]
+        return None
+
+    def read(self, digest: str):
+        """Return (kind, memoryview) of a packed object, sliced from the mapped pack."""
+        entry = self.lookup(digest)
+        if entry is None:
+            return None
+        offset, length, kind = entry
+        if length == 0:
+            return kind, memoryview(b'')
+        return kind, memoryview(self._data)[offset:offset + length]
+
+def _write_index(pack_path: str, entries: dict[str, tuple], data_size: int):
+    index_path = os.path.join(pack_path, INDEX_FILE)
+    tmp_path = get_tmp_path(index_path)
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(INDEX_MAGIC, len(entries), data_size))
+        for digest in sorted(entries):
+            f.write(_ENTRY.pack(bytes.fromhex(digest), *entries[digest]))
+    os.replace(tmp_path, index_path)
+
+@trace.traced("pack.write")
+def write_pack(pack_path: str, objects: dict[str, tuple]):
+    """Append objects ({digest: (kind, src_path)}) to the pack and rewrite its index.
+
+    The pack file is only appended to, so readers holding a mapping of it stay
+    valid; the index is replaced atomically once the data is on disk.
+    """
+    os.makedirs(pack_path, exist_ok=True)
+    pack = Pack.open(pack_path)
+    entries = {}
+    if pack is not None:
+        for digest, offset, length, kind in pack.entries():
+            entries[digest] = (offset, length, kind)
+    with open(os.path.join(pack_path, PACK_FILE), 'ab') as fpack:
+        offset = fpack.tell()
+        for digest, (kind, src_path) in sorted(objects.items()):
+            if digest in entries:
+                continue
+            with open(src_path, 'rb') as fsrc:
+                length = os.fstat(fsrc.fileno()).st_size
+                shutil.copyfileobj(fsrc, fpack, BLOCK_SIZE)
+            entries[digest] = (offset, length, kind)
+            offset += length
+        fpack.flush()
+        os.fsync(fpack.fileno())
+    _write_index(pack_path, entries, offset)
+
+@trace.traced("pack.rewrite")
+def rewrite_pack(pack_path: str, keep: set[str]) -> int:
+    """Rewrite the pack with only the objects in keep, returning the number of bytes freed.
+
+    The data file is replaced before the index, so a reader either sees the old
+    pair, the new pair, or an old index with new, shorter data, which Pack.open
+    detects.
+    """
+    pack = Pack.open(pack_path)
+    if pack is None:
+        return 0
+    data_path = os.path.join(pack_path, PACK_FILE)
+    tmp_path = get_tmp_path(data_path)
+    entries = {}
+    offset = 0
+    with open(tmp_path, 'wb') as f:
+        for digest, start, length, kind in pack.entries():
+            if digest not in keep:
+                continue
+            f.write(memoryview(pack._data)[start:start + length] if length else b'')
+            entries[digest] = (offset, length, kind)
+            offset += length
+        f.flush()
+        os.fsync(f.fileno())
+    freed = os.path.getsize(data_path) - offset
+    os.replace(tmp_path, data_path)
+    _write_index(pack_path, entries, offset)
+    return freed
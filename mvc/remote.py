@@ -0,0 +1,477 @@
+import io
+import os
+import json
+import socket
+import struct
+import hashlib
+import ipaddress
+import threading
+import http.client
+from contextlib import contextmanager, ExitStack
+from dataclasses import asdict, is_dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, quote, unquote
+from typing import List
+
+from mvc import serial, trace
+from mvc.core import MiniVC
+from mvc.helpers import MVCError, IntegrityError, Project, FileDiff, GarbageReport, VerifyReport, get_objects_path
+from mvc.helpers import BLOCK_SIZE, is_digest, check_digests, get_tmp_path
+from mvc.scan import normalize_path
+from mvc.transfer import TransferEngine, copy_file
+
+# files per bulk request; larger transfers are split over the connection pool
+TRANSFER_BATCH = 1000
+
+_DIGEST = struct.Struct(">32s")
+_BLOCK = struct.Struct(">I")
+
+# project side methods of MiniVC the server runs for clients
+RPC_METHODS = {
+    "_create_project", "_apply_batch", "_load_plan", "_review_plan", "_status", "_contents",
+    "_get_project", "_file_digest", "list_projects", "rebuild_catalog", "diff", "gc", "pack", "verify",
+    "unlock",
+}
+
+# ----------------------------------------------------------------- #
+# A transfer is a sequence of frames: a binary digest followed by the
+# content in length-prefixed blocks, closed by an empty block.
+
+def _read_exact(f, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise MVCError("Transfer was cut off.")
+    return data
+
+def _iter_frames(f):
+    """Yield (digest, blocks) for every frame; blocks must be consumed before the next frame."""
+    while True:
+        key = f.read(_DIGEST.size)
+        if not key:
+            return
+        if len(key) != _DIGEST.size:
+            raise MVCError("Transfer was cut off.")
+        yield key.hex(), _iter_blocks(f)
+
+def _iter_blocks(f):
+    while True:
+        n, = _BLOCK.unpack(_read_exact(f, _BLOCK.size))
+        if n == 0:
+            return
+        yield _read_exact(f, n)
+
+def _write_frame(digest: str, f):
+    """Yield the frame of the content of f."""
+    yield _DIGEST.pack(bytes.fromhex(digest))
+    for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+        yield _BLOCK.pack(len(block)) + block
+    yield _BLOCK.pack(0)
+
+class _FrameReader(io.RawIOBase):
+    """Content of a single frame as a stream; closing it ends the request it came from."""
+
+    def __init__(self, blocks, stack: ExitStack):
+        self._blocks = blocks
+        self._stack = stack
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            self._pending = next(self._blocks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stack.close()
+        super().close()
+
+class _ChunkedReader(io.RawIOBase):
+    """Request body sent with Transfer-Encoding: chunked."""
+
+    def __init__(self, rfile):
+        self._rfile = rfile
+        self._left = 0
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._done:
+            return 0
+        if self._left == 0:
+            self._left = int(self._rfile.readline().split(b";")[0], 16)
+            if self._left == 0:
+                while self._rfile.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                self._done = True
+                return 0
+        data = self._rfile.read(min(len(b), self._left))
+        if not data:
+            raise MVCError("Transfer was cut off.")
+        b[:len(data)] = data
+        self._left -= len(data)
+        if self._left == 0:
+            self._rfile.readline()
+        return len(data)
+
+# ----------------------------------------------------------------- #
+
+class _ServerMiniVC(MiniVC):
+    """MiniVC on the server side of a remote base path, without a workspace."""
+
+    def __init__(self, base_path: str, workers: int = None):
+        super().__init__(base_path, None, workers)
+
+    def _apply_batch(self, steps: List[dict], infos: dict[str, list]) -> dict[str, str]:
+        if not isinstance(steps, list):
+            raise MVCError("Batch steps must be a list.")
+        for i, step in enumerate(steps):
+            self._check_step(i, step)
+            for file in step.get("files", []):
+                if normalize_path(file) != file:
+                    raise MVCError(f"Invalid path {file}.")
+        if not isinstance(infos, dict):
+            raise MVCError("File infos must be an object.")
+        for file in {f for step in steps if step["op"] == "submit" for f in step["files"]}:
+            info = infos.get(file)
+            if not isinstance(info, list) or len(info) != 3 or not is_digest(info[0]):
+                raise MVCError(f"Invalid file info for {file}.")
+        return super()._apply_batch(steps, infos)
+
+    def _store_files(self, submitted: dict[str, List[str]], infos: dict[str, list]):
+        # content is uploaded before the batch; here it can only be checked
+        missing = []
+        for name, files in submitted.items():
+            project, project_path = self._get_project(name)
+            store = self._get_store(project_path)
+            missing += [file for file in files if not store.has(infos[file][0])]
+        if missing:
+            raise MVCError(f"Content of {', '.join(missing)} is missing on the server.")
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self._responded = False
+        try:
+            parts = [unquote(part) for part in self.path.strip("/").split("/")]
+            if len(parts) == 2 and parts[0] == "rpc" and parts[1] in RPC_METHODS:
+                self._rpc(parts[1])
+            elif len(parts) == 3 and parts[0] == "objects" and parts[2] == "missing":
+                self._missing(parts[1])
+            elif len(parts) == 3 and parts[0] == "objects" and parts[2] == "upload":
+                self._upload(parts[1])
+            elif len(parts) == 3 and parts[0] == "objects" and parts[2] == "fetch":
+                self._fetch(parts[1])
+            else:
+                self._drain()
+                self._send_json(404, {"error": f"Unknown request {self.path}."})
+        except Exception as e:
+            if self._responded:
+                # the response is already streaming, so the client sees a cut-off transfer
+                self.close_connection = True
+                return
+            message = str(e) if isinstance(e, MVCError) else f"{type(e).__name__}: {e}"
+            self.close_connection = True
+            self._send_json(409 if isinstance(e, MVCError) else 500, {"error": message})
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            return io.BufferedReader(_ChunkedReader(self.rfile), BLOCK_SIZE)
+        return io.BytesIO(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    def _drain(self):
+        body = self._body()
+        while body.read(BLOCK_SIZE):
+            pass
+
+    def _read_json(self):
+        return json.loads(self._body().read() or b"null")
+
+    def _send_json(self, status: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self._responded = True
+
+    def _store(self, project_name: str):
+        project, project_path = self.server.mvc._get_project(project_name)
+        return self.server.mvc._get_store(project_path, project.chunking, project.compression)
+
+    def _rpc(self, method: str):
+        args = self._read_json()["args"]
+        result = getattr(self.server.mvc, method)(*args)
+        if method == "_get_project":
+            result = asdict(result[0])
+        elif is_dataclass(result):
+            result = asdict(result)
+        elif isinstance(result, list):
+            result = [asdict(item) if is_dataclass(item) else item for item in result]
+        self._send_json(200, {"result": result})
+
+    def _missing(self, project_name: str):
+        digests = check_digests(self._read_json())
+        store = self._store(project_name)
+        self._send_json(200, [digest for digest in digests if not store.has(digest)])
+
+    def _upload(self, project_name: str):
+        store = self._store(project_name)
+        tmp_root = os.path.join(store.root, "incoming")
+        os.makedirs(tmp_root, exist_ok=True)
+        stored = 0
+        for digest, blocks in _iter_frames(self._body()):
+            tmp_path = get_tmp_path(os.path.join(tmp_root, digest))
+            try:
+                sha = hashlib.sha256()
+                with open(tmp_path, 'wb') as f:
+                    for block in blocks:
+                        sha.update(block)
+                        f.write(block)
+                if sha.hexdigest() != digest:
+                    raise MVCError(f"Uploaded content does not match {digest}.")
+                store.put(tmp_path, digest)
+                stored += 1
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self._send_json(200, {"stored": stored})
+
+    def _fetch(self, project_name: str):
+        digests = check_digests(self._read_json())
+        store = self._store(project_name)
+        missing = [digest for digest in digests if not store.has(digest)]
+        if missing:
+            raise MVCError(f"Missing object {missing[0]}.")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._responded = True
+        for digest in digests:
+            with store.open(digest) as f:
+                for data in _write_frame(digest, f):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.write(b"0\r\n\r\n")
+
+def _is_loopback(host: str) -> bool:
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address.split("%")[0]).is_loopback for address in addresses)
+
+class MVCServer(ThreadingHTTPServer):
+    """HTTP front end to a base path, serving RemoteMiniVC clients.
+
+    The server does not authenticate clients: anyone who can connect can
+    read, change and garbage collect every project of the base path. It
+    therefore only binds to loopback addresses unless allow_remote is set,
+    which should be combined with a firewall or an authenticating proxy.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, base_path: str, host: str = "127.0.0.1", port: int = 8750, workers: int = None,
+                 allow_remote: bool = False):
+        if not allow_remote and not _is_loopback(host):
+            raise MVCError(f"Refusing to serve on {host}, which is not a loopback address; "
+                           "the server has no authentication.")
+        self.mvc = _ServerMiniVC(base_path, workers)
+        super().__init__((host, port), _Handler)
+
+def serve(base_path: str, host: str = "127.0.0.1", port: int = 8750, workers: int = None,
+          allow_remote: bool = False):
+    with MVCServer(base_path, host, port, workers, allow_remote) as server:
+        print(f"serving {base_path} on http://{host}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+# ----------------------------------------------------------------- #
+
+class _ConnectionPool:
+    """Persistent HTTP connections to one server, shared between threads."""
+
+    def __init__(self, url: str, timeout: float = 300):
+        parts = urlsplit(url)
+        self.url = url
+        self.prefix = parts.path.rstrip("/")
+        self._connection = lambda: (http.client.HTTPSConnection if parts.scheme == "https" else
+                                    http.client.HTTPConnection)(parts.hostname, parts.port, timeout=timeout)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connection(), False
+
+    @contextmanager
+    def request(self, path: str, body=None):
+        """POST to path and yield the response; body is bytes or a function returning an iterable of bytes."""
+        for attempt in (0, 1):
+            conn, reused = self._acquire()
+            try:
+                conn.request("POST", self.prefix + path, body() if callable(body) else body)
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                # an idle connection the server has closed in the meantime
+                if not reused or attempt == 1:
+                    raise MVCError(f"Lost connection to {self.url}: {e}")
+            except OSError as e:
+                conn.close()
+                raise MVCError(f"Cannot reach {self.url}: {e}")
+        trace.count("http_requests")
+        try:
+            if response.status != 200:
+                try:
+                    error = json.loads(response.read())["error"]
+                except (ValueError, KeyError):
+                    error = f"{response.status} {response.reason}"
+                raise MVCError(error)
+            yield response
+            response.read()
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.append(conn)
+
+    def call(self, path: str, data):
+        with self.request(path, json.dumps(data).encode()) as response:
+            return json.loads(response.read())
+
+class RemoteMiniVC(MiniVC):
+    """MiniVC with its base path behind an mvc serve HTTP server.
+
+    Scanning, hashing and the index stay local to the workspace. Project
+    operations are single requests, and file contents move in streamed bulk
+    requests, split over a pool of persistent connections.
+    """
+
+    def __init__(self, url: str, user_path: str, workers: int = None):
+        self.base_path = url
+        self.user_path = user_path
+        self.transfer = TransferEngine(workers)
+        self.link = "copy"
+        self.pool = _ConnectionPool(url)
+
+    def _call(self, method: str, *args):
+        return self.pool.call(f"/rpc/{method}", {"args": args})["result"]
+
+    def _objects_path(self, project_name: str, action: str) -> str:
+        return f"/{get_objects_path()}/{quote(project_name, safe='')}/{action}"
+
+    def _batches(self, items: list) -> list:
+        return [items[i:i + TRANSFER_BATCH] for i in range(0, len(items), TRANSFER_BATCH)]
+
+    def _store_files(self, submitted: dict[str, List[str]], infos: dict[str, list]):
+        for name, files in submitted.items():
+            by_digest = {infos[file][0]: file for file in files}
+            missing = self.pool.call(self._objects_path(name, "missing"), sorted(by_digest))
+            def upload(digests):
+                def frames():
+                    for digest in digests:
+                        with open(os.path.join(self.user_path, by_digest[digest]), 'rb') as f:
+                            yield from _write_frame(digest, f)
+                with self.pool.request(self._objects_path(name, "upload"), frames) as response:
+                    response.read()
+            self.transfer.run(upload, self._batches(missing))
+
+    def _export_files(self, project_name: str, files: dict[str, str]):
+        by_digest = {}
+        for file, digest in files.items():
+            by_digest.setdefault(digest, []).append(file)
+        def fetch(digests):
+            with self.pool.request(self._objects_path(project_name, "fetch"), json.dumps(digests).encode()) as response:
+                for digest, blocks in _iter_frames(response):
+                    first, *copies = by_digest[digest]
+                    paths = [os.path.join(self.user_path, file) for file in (first, *copies)]
+                    for path in paths:
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                    sha = hashlib.sha256()
+                    with open(paths[0], 'wb') as f:
+                        for block in blocks:
+                            sha.update(block)
+                            f.write(block)
+                    if sha.hexdigest() != digest:
+                        os.remove(paths[0])
+                        raise IntegrityError(f"Object {digest} was corrupted in transfer.")
+                    for path in paths[1:]:
+                        copy_file(paths[0], path)
+        self.transfer.run(fetch, self._batches(sorted(by_digest)))
+
+    def open(self, project_name: str, path: str, version="latest"):
+        digest = self._call("_file_digest", project_name, path, version)
+        with ExitStack() as stack:
+            response = stack.enter_context(
+                self.pool.request(self._objects_path(project_name, "fetch"), json.dumps([digest]).encode()))
+            _, blocks = next(_iter_frames(response))
+            return io.BufferedReader(_FrameReader(blocks, stack.pop_all()), BLOCK_SIZE)
+
+    def _get_project(self, project_name: str):
+        data = self._call("_get_project", project_name)
+        return serial.loads(Project, json.dumps(data).encode()), None
+
+    def _create_project(self, name: str, chunking: bool, compression: str):
+        self._call("_create_project", name, chunking, compression)
+
+    def _apply_batch(self, steps: List[dict], infos: dict[str, list]) -> dict[str, str]:
+        return self._call("_apply_batch", steps, infos)
+
+    def _load_plan(self, project_name: str, release: int):
+        return tuple(self._call("_load_plan", project_name, release))
+
+    def _review_plan(self, project_name: str):
+        return tuple(self._call("_review_plan", project_name))
+
+    def _status(self, project_name: str) -> List[str]:
+        return self._call("_status", project_name)
+
+    def _contents(self, project_name: str) -> List[str]:
+        return self._call("_contents", project_name)
+
+    def list_projects(self, prefix: str = "", offset: int = 0, limit: int = None,
+                      min_release: int = None, pending: bool = None) -> dict[str, str]:
+        return self._call("list_projects", prefix, offset, limit, min_release, pending)
+
+    def rebuild_catalog(self) -> int:
+        return self._call("rebuild_catalog")
+
+    def diff(self, project_name: str, a="latest", b="dev") -> FileDiff:
+        return FileDiff(**self._call("diff", project_name, a, b))
+
+    def gc(self, project_name: str, keep: int = None, dry_run: bool = False, grace: float = 3600) -> GarbageReport:
+        return GarbageReport(**self._call("gc", project_name, keep, dry_run, grace))
+
+    def pack(self, project_name: str, keep: int = 1) -> int:
+        return self._call("pack", project_name, keep)
+
+    def unlock(self, project_name: str) -> dict:
+        return self._call("unlock", project_name)
+
+    def verify(self, project_name: str = None, memory: int = 64 << 20) -> List[VerifyReport]:
+        return [VerifyReport(**report) for report in self._call("verify", project_name, memory)]
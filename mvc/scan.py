@@ -0,0 +1,101 @@
+import os
+import fnmatch
+
+from mvc import trace
+from mvc.helpers import MVCError
+
+IGNORE_FILE = ".mvcignore"
+# metadata mvc keeps in the root of a workspace
+RESERVED_FILES = (".mvc", ".mvcindex", "changelog.md")
+
+def normalize_path(file: str) -> str:
+    """Workspace relative path in the form stored in metadata, with / separators."""
+    path = os.path.normpath(file)
+    if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise MVCError(f"{file} is outside the workspace.")
+    return path.replace(os.sep, "/")
+
+def is_under(file: str, path: str) -> bool:
+    return path == "." or file == path or file.startswith(path + "/")
+
+def matches(file: str, patterns: list[str]) -> bool:
+    """Whether file matches one of the glob patterns or lies below a directory named by one.
+
+    As in fnmatch, a * also matches across / separators.
+    """
+    for pattern in patterns:
+        pattern = pattern.strip("/") or "."
+        if is_under(file, pattern) or fnmatch.fnmatchcase(file, pattern):
+            return True
+    return False
+
+def select_paths(files, include: list[str] = None, exclude: list[str] = None) -> list[str]:
+    """The files matching include, or all of them without include, that do not match exclude."""
+    return [file for file in files
+            if (not include or matches(file, include)) and not (exclude and matches(file, exclude))]
+
+class IgnoreRules:
+    """Patterns of an .mvcignore file, a subset of the .gitignore syntax.
+
+    Blank lines and lines starting with # are skipped. A pattern containing a /
+    is matched against the whole relative path, other patterns against the
+    name at any depth, and a trailing / only matches directories. An ignored
+    directory is not scanned at all.
+    """
+
+    def __init__(self, patterns: list[str] = ()):
+        self.names = []
+        self.paths = []
+        for line in patterns:
+            pattern = line.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if "/" in pattern:
+                self.paths.append((pattern.lstrip("/"), dir_only))
+            else:
+                self.names.append((pattern, dir_only))
+
+    @classmethod
+    def load(cls, root: str):
+        try:
+            with open(os.path.join(root, IGNORE_FILE), 'r') as f:
+                return cls(f.read().splitlines())
+        except FileNotFoundError:
+            return cls()
+
+    def ignored(self, path: str, is_dir: bool) -> bool:
+        if "/" not in path and path in RESERVED_FILES:
+            return True
+        name = path.rsplit("/", 1)[-1]
+        for pattern, dir_only in self.names:
+            if (is_dir or not dir_only) and fnmatch.fnmatchcase(name, pattern):
+                return True
+        for pattern, dir_only in self.paths:
+            if (is_dir or not dir_only) and fnmatch.fnmatchcase(path, pattern):
+                return True
+        return False
+
+def scan_tree(root: str, path: str = ".", rules: IgnoreRules = None) -> dict[str, os.stat_result]:
+    """Stat results of all files below root/path that are not ignored, keyed by relative path.
+
+    One os.scandir pass per directory; symlinked directories are not followed.
+    """
+    if rules is None:
+        rules = IgnoreRules.load(root)
+    files = {}
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        prefix = "" if current == "." else current + "/"
+        trace.count("dir_scans")
+        with os.scandir(os.path.join(root, current)) as entries:
+            for entry in entries:
+                rel = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if not rules.ignored(rel, True):
+                        stack.append(rel)
+                elif entry.is_file() and not rules.ignored(rel, False):
+                    files[rel] = entry.stat()
+    return dict(sorted(files.items()))
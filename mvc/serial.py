@@ -0,0 +1,214 @@
+import json
+import struct
+import typing
+from dataclasses import asdict, fields, MISSING
+
+from mvc.helpers import MVCError, FileID
+
+MAGIC = b"MVCB"
+FORMAT_VERSION = 1
+
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_F64 = struct.Struct("<d")
+_FILE_ID = struct.Struct("<III")
+_HEADER = struct.Struct("<4sBI")
+
+# tags of the values in dict[str, str] fields
+_TAG_STR = 0
+_TAG_DIGEST = 1
+_TAG_FLOAT = 2
+_TAG_INT = 3
+
+class JSONFormat:
+    """The original, human readable format."""
+
+    def dump(self, obj) -> bytes:
+        return json.dumps(asdict(obj), indent=4).encode()
+
+    def load(self, cls, data: bytes):
+        def object_hook(d: dict):
+            if all(field in d for field in FileID.__annotations__):
+                return FileID(**d)
+            return d
+        return cls(**json.loads(data, object_hook=object_hook))
+
+class _Writer:
+    def __init__(self):
+        self.strings = {}
+
+    def intern(self, s: str) -> int:
+        return self.strings.setdefault(s, len(self.strings))
+
+    def value(self, tp, value) -> bytes:
+        origin = typing.get_origin(tp)
+        if tp is str:
+            raw = value.encode()
+            return _U32.pack(len(raw)) + raw
+        if tp is bool:
+            return bytes([bool(value)])
+        if tp is int:
+            return _I64.pack(value)
+        if tp is FileID:
+            return _FILE_ID.pack(value.release, value.save, value.submit)
+        if origin is list:
+            item_type, = typing.get_args(tp)
+            return _U32.pack(len(value)) + b"".join(self.value(item_type, v) for v in value)
+        if origin is dict:
+            _, value_type = typing.get_args(tp)
+            parts = [_U32.pack(len(value))]
+            for k, v in value.items():
+                parts.append(_U32.pack(self.intern(k)))
+                parts.append(self.tagged(v) if value_type is str else self.value(value_type, v))
+            return b"".join(parts)
+        raise MVCError(f"Cannot encode metadata of type {tp}.")
+
+    def tagged(self, value) -> bytes:
+        if isinstance(value, str):
+            if len(value) == 64 and value == value.lower():
+                try:
+                    return bytes([_TAG_DIGEST]) + bytes.fromhex(value)
+                except ValueError:
+                    pass
+            return bytes([_TAG_STR]) + self.value(str, value)
+        if isinstance(value, float):
+            return bytes([_TAG_FLOAT]) + _F64.pack(value)
+        return bytes([_TAG_INT]) + _I64.pack(value)
+
+class _Reader:
+    def __init__(self, data: bytes, strings: list):
+        self.data = data
+        self.pos = 0
+        self.strings = strings
+
+    def unpack(self, st: struct.Struct):
+        values = st.unpack_from(self.data, self.pos)
+        self.pos += st.size
+        return values
+
+    def value(self, tp):
+        origin = typing.get_origin(tp)
+        if tp is str:
+            n, = self.unpack(_U32)
+            self.pos += n
+            return self.data[self.pos - n:self.pos].decode()
+        if tp is bool:
+            self.pos += 1
+            return bool(self.data[self.pos - 1])
+        if tp is int:
+            return self.unpack(_I64)[0]
+        if tp is FileID:
+            return FileID(*self.unpack(_FILE_ID))
+        if origin is list:
+            item_type, = typing.get_args(tp)
+            n, = self.unpack(_U32)
+            return [self.value(item_type) for _ in range(n)]
+        if origin is dict:
+            _, value_type = typing.get_args(tp)
+            n, = self.unpack(_U32)
+            ret = {}
+            for _ in range(n):
+                key = self.strings[self.unpack(_U32)[0]]
+                ret[key] = self.tagged() if value_type is str else self.value(value_type)
+            return ret
+        raise MVCError(f"Cannot decode metadata of type {tp}.")
+
+    def tagged(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == _TAG_DIGEST:
+            self.pos += 32
+            return self.data[self.pos - 32:self.pos].hex()
+        if tag == _TAG_STR:
+            return self.value(str)
+        if tag == _TAG_FLOAT:
+            return self.unpack(_F64)[0]
+        return self.unpack(_I64)[0]
+
+class BinaryFormat:
+    """Compact binary encoding of the metadata dataclasses.
+
+    After a header holding the format version, every field is stored as a
+    named, length-prefixed section, followed by a table of the dict keys
+    (mostly file names), each stored once. Scalar fields are decoded on load;
+    list and dict sections are only decoded on first access, so reading
+    project.id does not parse the timestamp table.
+    """
+
+    def dump(self, obj) -> bytes:
+        writer = _Writer()
+        sections = []
+        for f in fields(obj):
+            payload = writer.value(f.type, getattr(obj, f.name))
+            sections.append(writer.value(str, f.name) + _U32.pack(len(payload)) + payload)
+        strings = list(writer.strings)
+        table = _U32.pack(len(strings)) + b"".join(writer.value(str, s) for s in strings)
+        return b"".join([_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)), *sections, table])
+
+    def load(self, cls, data: bytes):
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        if version > FORMAT_VERSION:
+            raise MVCError(f"Metadata format version {version} is not supported.")
+        reader = _Reader(data, None)
+        reader.pos = _HEADER.size
+        sections = {}
+        for _ in range(count):
+            name = reader.value(str)
+            length, = reader.unpack(_U32)
+            sections[name] = (reader.pos, length)
+            reader.pos += length
+        table_pos = reader.pos
+        obj = cls.__new__(cls)
+        lazy = {}
+        for f in fields(cls):
+            if f.name not in sections:
+                if f.default is not MISSING:
+                    setattr(obj, f.name, f.default)
+                elif f.default_factory is not MISSING:
+                    setattr(obj, f.name, f.default_factory())
+                else:
+                    raise MVCError(f"Metadata is missing the field {f.name}.")
+                continue
+            pos, length = sections[f.name]
+            if typing.get_origin(f.type) in (list, dict):
+                lazy[f.name] = (f.type, data[pos:pos + length])
+            else:
+                field_reader = _Reader(data, None)
+                field_reader.pos = pos
+                setattr(obj, f.name, field_reader.value(f.type))
+        if lazy:
+            obj.__dict__["_lazy"] = _LazySections(lazy, data[table_pos:])
+        return obj
+
+class _LazySections:
+    def __init__(self, sections: dict, table: bytes):
+        self.sections = sections
+        self.table = table
+        self.strings = None
+
+    def decode(self, name: str):
+        tp, payload = self.sections.pop(name)
+        if self.strings is None:
+            reader = _Reader(self.table, None)
+            n, = reader.unpack(_U32)
+            self.strings = [reader.value(str) for _ in range(n)]
+        return _Reader(payload, self.strings).value(tp)
+
+FORMATS = {
+    "json": JSONFormat(),
+    "binary": BinaryFormat(),
+}
+
+def dumps(obj, format: str) -> bytes:
+    if format not in FORMATS:
+        raise MVCError(f"Unknown metadata format {format!r}.")
+    return FORMATS[format].dump(obj)
+
+def loads(cls, data: bytes):
+    """Decode metadata in any known format; JSON files written before the binary format load as-is."""
+    if data[:len(MAGIC)] == MAGIC:
+        try:
+            return FORMATS["binary"].load(cls, data)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise MVCError("Invalid metadata file.")
+    return FORMATS["json"].load(cls, data)
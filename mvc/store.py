@@ -0,0 +1,397 @@
+import io
+import os
+import json
+import time
+import hashlib
+
+from mvc import trace
+from mvc.helpers import MVCError, IntegrityError, BLOCK_SIZE, is_digest, get_tmp_path
+from mvc.transfer import copy_file, copy_verified, link_file
+from mvc.pack import Pack, MemoryReader, KIND_BLOB, KIND_CHUNKS, write_pack, rewrite_pack
+from mvc.compress import CODECS, KIND_CODECS, SAMPLE_SIZE, DecompressReader, get_codec, is_compressible, compress_stream
+
+# content-defined chunking, applied to files of at least CHUNK_THRESHOLD bytes
+CHUNK_THRESHOLD = 4 << 20
+CHUNK_MIN = 256 << 10
+CHUNK_MAX = 4 << 20
+CHUNK_BITS = 20
+# cut candidates end _CANDIDATE_BITS bytes whose selector bits spell _CANDIDATE;
+# the remaining bits come from a hash of the _CUT_WINDOW bytes before the cut
+_CANDIDATE_BITS = 8
+_CUT_WINDOW = 32
+_CUT_LIMIT = 1 << (64 - CHUNK_BITS + _CANDIDATE_BITS)
+_SELECT = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+_CANDIDATE = bytes((0x9E3779B97F4A7C15 >> i) & 1 for i in range(_CANDIDATE_BITS))
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+            size += len(block)
+    trace.count("files_hashed")
+    trace.count("bytes_hashed", size)
+    return digest.hexdigest()
+
+def _find_cut(data: bytearray) -> int:
+    end = min(len(data), CHUNK_MAX)
+    if end <= CHUNK_MIN:
+        return end
+    # translate and find scan in C; only candidates, about one byte in 256, are hashed
+    start = CHUNK_MIN - _CANDIDATE_BITS + 1
+    find = data[start:end].translate(_SELECT).find
+    pos = find(_CANDIDATE)
+    while pos >= 0:
+        cut = start + pos + _CANDIDATE_BITS
+        window = hashlib.blake2b(data[cut - _CUT_WINDOW:cut], digest_size=8).digest()
+        if int.from_bytes(window, 'little') < _CUT_LIMIT:
+            return cut
+        pos = find(_CANDIDATE, pos + 1)
+    return end
+
+def iter_chunks(f):
+    """Split a binary stream into content-defined chunks.
+
+    Cut points depend only on the bytes just before them, so an insertion
+    moves the chunk boundaries around it and leaves the others in place.
+    """
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < CHUNK_MAX:
+            block = f.read(CHUNK_MAX - len(buf))
+            if not block:
+                eof = True
+            buf += block
+        if not buf:
+            return
+        cut = _find_cut(buf)
+        with memoryview(buf) as view:
+            chunk = bytes(view[:cut])
+        yield chunk
+        del buf[:cut]
+
+class ChunkReader(io.RawIOBase):
+    """Read-only stream over the concatenated chunks of a chunked object."""
+
+    def __init__(self, store, chunks: list):
+        self._store = store
+        self._chunks = iter(chunks)
+        self._current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self._current is None:
+                try:
+                    digest, _ = next(self._chunks)
+                except StopIteration:
+                    return 0
+                self._current = self._store.open(digest)
+            n = self._current.readinto(b)
+            if n:
+                return n
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+class BlobStore:
+    """Content-addressable file storage, keyed by the SHA-256 of the content.
+
+    With chunking enabled, large files are stored as a list of content-defined
+    chunks, so a small edit to a large file only stores the chunks around it.
+    With a compression codec, new objects (or chunks) are stored compressed
+    unless a sample of them does not compress. Objects are looked up as loose
+    files first and then in the project pack. link is the mode picked by
+    detect_link_mode: with "reflink" stored and exported files share extents,
+    with "hardlink" plain loose objects are exported as read-only hardlinks.
+    """
+
+    def __init__(self, root: str, chunking: bool = False, pack_path: str = None, compression: str = None,
+                 link: str = "copy"):
+        self.root = root
+        self.link = link
+        self.chunking = chunking
+        self.pack_path = pack_path
+        self.codec = get_codec(compression)
+        # loose objects may have been written with any codec
+        self._codecs = [None] + sorted(CODECS.values(), key=lambda codec: codec is not self.codec)
+        self._pack = None
+
+    @property
+    def pack(self):
+        if self._pack is None and self.pack_path is not None:
+            self._pack = Pack.open(self.pack_path)
+        return self._pack
+
+    def _object_path(self, digest: str) -> str:
+        assert is_digest(digest), digest
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def _write_atomic(self, dst_path: str, data: bytes):
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        tmp_path = get_tmp_path(dst_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, dst_path)
+        trace.count("bytes_stored", len(data))
+
+    def _find_loose(self, digest: str):
+        """(path, codec) of the loose object, or None."""
+        path = self._object_path(digest)
+        for codec in self._codecs:
+            candidate = path + codec.suffix if codec else path
+            if os.path.exists(candidate):
+                return candidate, codec
+        return None
+
+    def _chunks(self, digest: str):
+        try:
+            with open(self._object_path(digest) + ".chunks", 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        packed = self._packed(digest)
+        if packed is not None and packed[0] == KIND_CHUNKS:
+            return json.loads(bytes(packed[1]))
+        return None
+
+    def _packed(self, digest: str, reload: bool = False):
+        if reload:
+            # the object may have been packed since the pack was opened
+            self._pack = None
+        if self.pack is None:
+            return None
+        return self.pack.read(digest)
+
+    def has(self, digest: str) -> bool:
+        if self._find_loose(digest) or os.path.exists(self._object_path(digest) + ".chunks"):
+            return True
+        return self.pack is not None and self.pack.lookup(digest) is not None
+
+    def check(self, digest: str) -> tuple[str, int]:
+        """Read an object in blocks and return "ok", "corrupt" or "missing" with the bytes read."""
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            if not self.has(digest):
+                return "missing", 0
+            with self.open(digest) as f:
+                for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                    sha.update(block)
+                    size += len(block)
+        except Exception:
+            # unreadable chunk lists, truncated or garbled compressed data
+            return "corrupt", size
+        finally:
+            trace.count("bytes_verified", size)
+        return ("ok" if sha.hexdigest() == digest else "corrupt"), size
+
+    @trace.traced("store.put")
+    def put(self, src_path: str, digest: str = None) -> str:
+        if digest is None:
+            digest = hash_file(src_path)
+        if self.has(digest):
+            trace.count("objects_deduplicated")
+            return digest
+        trace.count("objects_written")
+        dst_path = self._object_path(digest)
+        if self.chunking and os.path.getsize(src_path) >= CHUNK_THRESHOLD:
+            chunks = []
+            sha = hashlib.sha256()
+            with open(src_path, 'rb') as f:
+                for chunk in iter_chunks(f):
+                    sha.update(chunk)
+                    chunk_digest = hashlib.sha256(chunk).hexdigest()
+                    if not self.has(chunk_digest):
+                        chunk_path = self._object_path(chunk_digest)
+                        data = chunk
+                        if self.codec is not None and is_compressible(chunk):
+                            chunk_path += self.codec.suffix
+                            compressor = self.codec.compressor()
+                            data = compressor.compress(chunk) + compressor.flush()
+                        self._write_atomic(chunk_path, data)
+                    chunks.append([chunk_digest, len(chunk)])
+            # stray chunks of a file changed while it was stored are left to gc
+            if sha.hexdigest() != digest:
+                raise IntegrityError(f"{src_path} changed while it was stored.")
+            self._write_atomic(dst_path + ".chunks", json.dumps(chunks).encode())
+            return digest
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        with open(src_path, 'rb') as fsrc:
+            if self.codec is not None and is_compressible(fsrc.read(SAMPLE_SIZE)):
+                fsrc.seek(0)
+                dst_path += self.codec.suffix
+                tmp_path = get_tmp_path(dst_path)
+                sha = hashlib.sha256()
+                with open(tmp_path, 'wb') as fdst:
+                    trace.count("bytes_stored", compress_stream(self.codec, fsrc, fdst, sha))
+                if sha.hexdigest() != digest:
+                    os.remove(tmp_path)
+                    raise IntegrityError(f"{src_path} changed while it was stored.")
+                os.replace(tmp_path, dst_path)
+                return digest
+        tmp_path = get_tmp_path(dst_path)
+        try:
+            copy_file(src_path, tmp_path, self.link != "copy", digest)
+        except IntegrityError:
+            os.remove(tmp_path)
+            raise IntegrityError(f"{src_path} changed while it was stored.")
+        os.replace(tmp_path, dst_path)
+        return digest
+
+    def open(self, digest: str):
+        chunks = self._chunks(digest)
+        if chunks is not None:
+            return io.BufferedReader(ChunkReader(self, chunks), BLOCK_SIZE)
+        path = self._object_path(digest)
+        for codec in self._codecs:
+            try:
+                f = open(path + codec.suffix if codec else path, 'rb')
+            except FileNotFoundError:
+                continue
+            if codec is None:
+                return f
+            return io.BufferedReader(DecompressReader(f, codec), BLOCK_SIZE)
+        packed = self._packed(digest) or self._packed(digest, reload=True)
+        if packed is None:
+            raise MVCError(f"Missing object {digest}.")
+        kind, view = packed
+        if kind == KIND_CHUNKS:
+            return io.BufferedReader(ChunkReader(self, json.loads(bytes(view))), BLOCK_SIZE)
+        if kind in KIND_CODECS:
+            return io.BufferedReader(DecompressReader(MemoryReader(view), KIND_CODECS[kind]), BLOCK_SIZE)
+        return io.BufferedReader(MemoryReader(view), BLOCK_SIZE)
+
+    def size(self, digest: str) -> int:
+        chunks = self._chunks(digest)
+        if chunks is not None:
+            return sum(length for _, length in chunks)
+        loose = self._find_loose(digest)
+        if loose is not None and loose[1] is None:
+            return os.path.getsize(loose[0])
+        if loose is None and self.pack is not None:
+            entry = self.pack.lookup(digest)
+            if entry is not None and entry[2] == KIND_BLOB:
+                return entry[1]
+        # only compressed objects are read to learn their size
+        with self.open(digest) as f:
+            return sum(len(block) for block in iter(lambda: f.read(BLOCK_SIZE), b''))
+
+    @trace.traced("store.export")
+    def export(self, digest: str, dst_path: str):
+        """Write an object to dst_path, checking its hash on the way unless it is linked."""
+        try:
+            self._export(digest, dst_path)
+        except IntegrityError:
+            os.remove(dst_path)
+            raise IntegrityError(f"Object {digest} is corrupt.")
+
+    def _export(self, digest: str, dst_path: str):
+        # the old file may be a hardlink to a stored object, so it is never written through
+        try:
+            os.remove(dst_path)
+        except FileNotFoundError:
+            pass
+        src_path = self._object_path(digest)
+        try:
+            if self.link == "hardlink":
+                try:
+                    link_file(src_path, dst_path)
+                    return
+                except FileNotFoundError:
+                    raise
+                except OSError:
+                    # the workspace is on another device
+                    pass
+            copy_file(src_path, dst_path, self.link != "copy", digest)
+            return
+        except FileNotFoundError:
+            pass
+        packed = self._packed(digest)
+        if packed is not None and packed[0] == KIND_BLOB:
+            with open(dst_path, 'wb') as fdst:
+                fdst.write(packed[1])
+            size = len(packed[1])
+            trace.count("bytes_verified", size)
+            if hashlib.sha256(packed[1]).hexdigest() != digest:
+                raise IntegrityError(f"Packed object {digest} is corrupt.")
+        else:
+            with self.open(digest) as fsrc, open(dst_path, 'wb') as fdst:
+                size = copy_verified(fsrc, fdst, digest, digest)
+        trace.count("files_copied")
+        trace.count("bytes_copied", size)
+
+    def pack_objects(self, digests):
+        """Move the given objects, and the chunks they consist of, into the pack."""
+        objects = {}
+        def add_loose(digest):
+            loose = self._find_loose(digest)
+            if loose is not None:
+                path, codec = loose
+                objects[digest] = (codec.kind if codec else KIND_BLOB, path)
+        for digest in digests:
+            path = self._object_path(digest)
+            chunks = self._chunks(digest)
+            if chunks is not None:
+                if os.path.exists(path + ".chunks"):
+                    objects[digest] = (KIND_CHUNKS, path + ".chunks")
+                for chunk_digest, _ in chunks:
+                    add_loose(chunk_digest)
+            else:
+                add_loose(digest)
+        if not objects:
+            return 0
+        write_pack(self.pack_path, objects)
+        self._pack = None
+        for _, path in objects.values():
+            os.remove(path)
+        return len(objects)
+
+    @trace.traced("store.sweep")
+    def sweep(self, digests, grace: float = 3600, dry_run: bool = False) -> tuple[list[str], list[str], int]:
+        """Delete the objects not reachable from digests.
+
+        Temporary files are only deleted once they are grace seconds old, as
+        they may belong to a write still in progress. Returns the loose files
+        and packed digests found, relative to root, and their total size.
+        """
+        live = set(digests)
+        for digest in digests:
+            live.update(chunk_digest for chunk_digest, _ in self._chunks(digest) or ())
+        cutoff = time.time() - grace
+        loose = []
+        size = 0
+        if os.path.isdir(self.root):
+            for directory in os.scandir(self.root):
+                if not directory.is_dir():
+                    continue
+                for entry in os.scandir(directory.path):
+                    if entry.name.endswith(".tmp"):
+                        garbage = entry.stat().st_mtime < cutoff
+                    else:
+                        garbage = directory.name + entry.name.split(".")[0] not in live
+                    if garbage:
+                        loose.append(os.path.join(directory.name, entry.name))
+                        size += entry.stat().st_size
+        packed = []
+        if self.pack is not None:
+            for digest, _, length, _ in self.pack.entries():
+                if digest not in live:
+                    packed.append(digest)
+                    size += length
+        if not dry_run:
+            for path in loose:
+                os.remove(os.path.join(self.root, path))
+            if packed:
+                rewrite_pack(self.pack_path, live)
+                self._pack = None
+        return loose, packed, size
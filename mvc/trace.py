@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+_active = contextvars.ContextVar("mvc_tracer", default=None)
+
+class Tracer:
+    """Collects counters and timed phases of the filesystem work done by mvc.
+
+    Tracing is opt-in: while a tracer is entered as a context manager, the mvc
+    calls of that thread or asyncio task report to it, including the work they
+    hand to worker threads through bind. Calls from other threads or tasks of
+    the process, such as other requests of a server, are not counted.
+
+        with Tracer() as tracer:
+            mvc.save()
+        print(tracer.report())
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_active.set(self))
+        return self
+
+    def __exit__(self, *exc):
+        _active.reset(self._tokens.pop())
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_event(self, name: str, start: float, end: float, args: dict):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    def report(self) -> dict:
+        """Counters plus the call count and total seconds of every phase."""
+        phases = {}
+        with self._lock:
+            for event in self.events:
+                phase = phases.setdefault(event["name"], {"calls": 0, "seconds": 0.0})
+                phase["calls"] += 1
+                phase["seconds"] += event["dur"] / 1e6
+            return {"counters": dict(self.counters), "phases": phases}
+
+    def write_chrome_trace(self, filename: str):
+        """Write the phases in the Chrome trace-event format (chrome://tracing, Perfetto)."""
+        with self._lock:
+            data = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(filename, 'w') as f:
+            json.dump(data, f)
+
+def bind(func):
+    """Wrap func to report to the current tracer when it runs on a worker thread."""
+    tracer = _active.get()
+    if tracer is None:
+        return func
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _active.set(tracer)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _active.reset(token)
+    return wrapper
+
+def count(name: str, n: int = 1):
+    tracer = _active.get()
+    if tracer is not None:
+        tracer.count(name, n)
+
+@contextmanager
+def span(name: str, **args):
+    tracer = _active.get()
+    if tracer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.add_event(name, start, time.perf_counter(), args)
+
+def traced(name: str):
+    """Decorator recording every call of the function as a phase."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
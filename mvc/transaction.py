@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import socket
+import threading
+
+from mvc import trace
+from mvc.helpers import MVCError, get_tmp_path
+
+LOCK_FILE = ".lock"
+JOURNAL_FILE = ".journal"
+# a lock file still empty or unreadable after this many seconds was abandoned
+# by a process that died between creating and writing it
+ABANDONED_LOCK_AGE = 30.0
+
+def _owner_is_dead(info: dict) -> bool:
+    if info.get("host") != socket.gethostname() or os.name != "posix":
+        return False
+    try:
+        os.kill(info["pid"], 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, KeyError, TypeError):
+        return False
+    return False
+
+def _describe(owner: dict) -> str:
+    if not owner:
+        return "an unknown process"
+    ret = f"{owner.get('host')}:{owner.get('pid')}"
+    if isinstance(owner.get("acquired"), (int, float)):
+        ret += f" since {time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(owner['acquired']))}"
+    return ret
+
+class ProjectLock:
+    """Exclusive lock on a project, held as a lock file created with O_EXCL.
+
+    Lock files work the same on local disks and network mounts. They record
+    the owner and when it took the lock. A lock left behind by a process that
+    died on this host, or left empty for ABANDONED_LOCK_AGE seconds, is broken
+    automatically; others can be broken with break_lock (mvc unlock).
+    """
+
+    def __init__(self, project_path: str, timeout: float = 60.0):
+        self.filename = os.path.join(project_path, LOCK_FILE)
+        self.timeout = timeout
+        self.token = f"{os.getpid()}.{threading.get_ident()}.{time.time_ns()}"
+
+    def _read_owner(self) -> dict:
+        try:
+            with open(self.filename, 'r') as f:
+                owner = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return owner if isinstance(owner, dict) else {}
+
+    def _abandoned(self) -> bool:
+        try:
+            return time.time() - os.stat(self.filename).st_mtime > ABANDONED_LOCK_AGE
+        except FileNotFoundError:
+            return False
+
+    def _is_stale(self, owner: dict) -> bool:
+        return _owner_is_dead(owner) if owner else self._abandoned()
+
+    def break_lock(self) -> dict:
+        """Remove the lock whoever holds it, returning what is known of the owner."""
+        owner = self._read_owner()
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            raise MVCError("Project is not locked.")
+        return owner
+
+    @trace.traced("lock.acquire")
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        delay = 0.001
+        info = {"host": socket.gethostname(), "pid": os.getpid(), "token": self.token, "acquired": time.time()}
+        while True:
+            try:
+                fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                owner = self._read_owner()
+                if self._is_stale(owner):
+                    # the lock may have been released and taken again meanwhile
+                    current = self._read_owner()
+                    if current.get("token") == owner.get("token") and self._is_stale(current):
+                        try:
+                            os.remove(self.filename)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                if time.monotonic() > deadline:
+                    raise MVCError(f"Project is locked by {_describe(owner)}; "
+                                   "run mvc unlock if its owner is gone.")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump(info, f)
+            return
+
+    def release(self):
+        if self._read_owner().get("token") == self.token:
+            os.remove(self.filename)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class Transaction:
+    """Reads and writes a project's metadata files, committing them atomically.
+
+    Each .mvc file is read at most once and written at most once, however
+    many operations touch it. On commit every file is first written to a
+    temporary name, the list of pending renames is recorded in the journal,
+    and only then are the files renamed into place. If a writer dies
+    half-way, recover() finishes the renames the next time the project is
+    locked.
+    """
+
+    def __init__(self, project_path: str):
+        self.project_path = project_path
+        self.loaded = {}
+        self.writes = {}
+        self.after_commit = []
+
+    def load(self, cls, filedir: str):
+        if filedir in self.writes:
+            return self.writes[filedir]
+        if filedir not in self.loaded:
+            self.loaded[filedir] = cls.load(filedir)
+        return self.loaded[filedir]
+
+    def save(self, obj, filedir: str):
+        self.writes[filedir] = obj
+
+    def on_commit(self, func):
+        self.after_commit.append(func)
+
+    @trace.traced("transaction.commit")
+    def commit(self):
+        renames = []
+        for filedir, obj in self.writes.items():
+            filename = os.path.join(filedir, ".mvc")
+            tmp_path = get_tmp_path(filename)
+            obj.write(tmp_path)
+            renames.append([os.path.relpath(tmp_path, self.project_path),
+                            os.path.relpath(filename, self.project_path)])
+        journal = os.path.join(self.project_path, JOURNAL_FILE)
+        with open(journal, 'w') as f:
+            json.dump(renames, f)
+            f.flush()
+            os.fsync(f.fileno())
+        _replay(self.project_path, renames)
+        os.remove(journal)
+        self.loaded.update(self.writes)
+        self.writes = {}
+        after_commit, self.after_commit = self.after_commit, []
+        for func in after_commit:
+            func()
+
+def _replay(project_path: str, renames: list):
+    for tmp_path, filename in renames:
+        tmp_path = os.path.join(project_path, tmp_path)
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, os.path.join(project_path, filename))
+
+def recover(project_path: str):
+    """Finish a journal left behind by an interrupted commit."""
+    journal = os.path.join(project_path, JOURNAL_FILE)
+    try:
+        with open(journal, 'r') as f:
+            renames = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        # the journal itself was not completely written, so nothing was renamed
+        renames = []
+    _replay(project_path, renames)
+    os.remove(journal)
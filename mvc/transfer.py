@@ -0,0 +1,187 @@
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mvc import trace
+from mvc.helpers import MVCError, TransferError, IntegrityError, BLOCK_SIZE, get_tmp_path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_FALLBACK_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP)
+# ioctl sharing the extents of one file with another, on Btrfs, XFS and the like
+FICLONE = 0x40049409
+
+# "auto" reflinks where the base path supports it and copies otherwise;
+# "hardlink" also allows read-only hardlinks where reflinks are unsupported
+LINK_MODES = ("auto", "copy", "hardlink")
+
+def _reflink(infd: int, outfd: int) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(outfd, FICLONE, infd)
+    except OSError as e:
+        if e.errno in _FALLBACK_ERRORS or e.errno in (errno.ENOTTY, errno.EPERM):
+            return False
+        raise
+    return True
+
+def _kernel_copy(func, infd: int, outfd: int, size: int) -> bool:
+    offset = 0
+    try:
+        while offset < size:
+            sent = func(infd, outfd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except OSError as e:
+        if offset == 0 and e.errno in _FALLBACK_ERRORS:
+            return False
+        raise
+    return True
+
+def _copy_file_range(infd: int, outfd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(infd, outfd, count, offset, offset)
+
+def _sendfile(infd: int, outfd: int, offset: int, count: int) -> int:
+    return os.sendfile(outfd, infd, offset, count)
+
+_KERNEL_COPIES = []
+if hasattr(os, "copy_file_range"):
+    _KERNEL_COPIES.append(_copy_file_range)
+if hasattr(os, "sendfile"):
+    _KERNEL_COPIES.append(_sendfile)
+
+def copy_file(src_path: str, dst_path: str, reflink: bool = False, digest: str = None):
+    """Copy content and metadata, letting the kernel move the bytes where it can.
+
+    With reflink, the copy first tries to share the extents of the source,
+    which takes no time and no space until either file is modified. With
+    digest, the bytes are hashed as they pass through and an IntegrityError
+    is raised if they do not match it; a reflink moves no bytes, so the clone
+    is read back and hashed instead.
+    """
+    with open(src_path, 'rb') as fsrc, open(dst_path, 'w+b') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if reflink and size > 0 and _reflink(fsrc.fileno(), fdst.fileno()):
+            trace.count("files_reflinked")
+            if digest is not None:
+                fdst.seek(0)
+                _check_digest(fdst, digest, src_path)
+        elif digest is not None:
+            size = copy_verified(fsrc, fdst, digest, src_path)
+            trace.count("files_copied")
+            trace.count("bytes_copied", size)
+        else:
+            for func in _KERNEL_COPIES:
+                if _kernel_copy(func, fsrc.fileno(), fdst.fileno(), size):
+                    break
+            else:
+                shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+            trace.count("files_copied")
+            trace.count("bytes_copied", size)
+    shutil.copystat(src_path, dst_path)
+
+def _check_digest(f, digest: str, name: str):
+    sha = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+        sha.update(block)
+        size += len(block)
+    trace.count("bytes_verified", size)
+    if sha.hexdigest() != digest:
+        raise IntegrityError(f"Content of {name} does not match {digest}.")
+
+def copy_verified(fsrc, fdst, digest: str, name: str) -> int:
+    """Copy one stream to another while hashing it, returning the size."""
+    sha = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: fsrc.read(BLOCK_SIZE), b''):
+        sha.update(block)
+        fdst.write(block)
+        size += len(block)
+    trace.count("bytes_verified", size)
+    if sha.hexdigest() != digest:
+        raise IntegrityError(f"Content of {name} does not match {digest}.")
+    return size
+
+def link_file(src_path: str, dst_path: str):
+    """Hardlink src_path at dst_path and make the shared file read-only.
+
+    The write bits are dropped so the stored object is not changed through
+    the link; an editor has to replace the file instead.
+    """
+    tmp_path = get_tmp_path(dst_path)
+    os.link(src_path, tmp_path)
+    try:
+        os.chmod(tmp_path, os.stat(tmp_path).st_mode & ~0o222)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    trace.count("files_linked")
+
+_link_modes = {}
+_link_modes_lock = threading.Lock()
+
+def detect_link_mode(path: str, mode: str = "auto") -> str:
+    """How files are best duplicated within path: "reflink", "hardlink" or "copy".
+
+    Probes path once per mode with a pair of temporary files; "hardlink" is
+    only returned when mode allows it.
+    """
+    if mode not in LINK_MODES:
+        raise MVCError(f"Unknown link mode {mode!r}, choose from {', '.join(LINK_MODES)}.")
+    if mode == "copy":
+        return "copy"
+    key = (os.path.realpath(path), mode)
+    with _link_modes_lock:
+        if key not in _link_modes:
+            _link_modes[key] = _probe_link_mode(path, mode)
+        return _link_modes[key]
+
+def _probe_link_mode(path: str, mode: str) -> str:
+    with tempfile.TemporaryDirectory(dir=path, prefix=".mvc-probe") as probe:
+        src_path = os.path.join(probe, "src")
+        with open(src_path, 'wb') as f:
+            f.write(b"probe")
+        with open(src_path, 'rb') as fsrc, open(os.path.join(probe, "dst"), 'wb') as fdst:
+            if _reflink(fsrc.fileno(), fdst.fileno()):
+                return "reflink"
+        if mode == "hardlink":
+            try:
+                os.link(src_path, os.path.join(probe, "link"))
+                return "hardlink"
+            except OSError:
+                pass
+    return "copy"
+
+class TransferEngine:
+    """Runs a batch of file operations on a shared worker pool."""
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+
+    def run(self, func, items: list) -> list:
+        """Apply func to every item, raising a TransferError listing all failures."""
+        def attempt(item):
+            try:
+                return func(item), None
+            except Exception as e:
+                return None, e
+        if self.workers == 1 or len(items) < 2:
+            outcomes = [attempt(item) for item in items]
+        else:
+            with ThreadPoolExecutor(min(self.workers, len(items))) as pool:
+                outcomes = list(pool.map(trace.bind(attempt), items))
+        errors = [(item, e) for item, (_, e) in zip(items, outcomes) if e is not None]
+        if errors:
+            raise TransferError(errors)
+        return [result for result, _ in outcomes]
@@ -1,5 +1,26 @@
 import unittest
+import asyncio
+import json
+import random
+import threading
+import io
+import stat
+import time
+from contextlib import redirect_stdout, redirect_stderr
+from unittest import mock
 from mvc.core import MiniVC, FileOperation
+from mvc.store import BlobStore, hash_file
+from mvc.index import WorkspaceIndex, INDEX_FILE
+from mvc.transfer import detect_link_mode
+from mvc.compress import CODECS
+from mvc.helpers import MVCError, IntegrityError
+from mvc.helpers import Project, Version, Workspace, FileID, FileDiff, VerifyReport, JSONBase, MetadataCache
+from mvc import daemon
+from mvc.__main__ import cli, main
+from mvc.aio import AsyncMiniVC
+from mvc.remote import MVCServer, RemoteMiniVC
+from mvc.trace import Tracer
+from mvc.transaction import ProjectLock, LOCK_FILE
 import os
 import shutil
 
@@ -45,7 +66,7 @@ class TestMVC(unittest.TestCase):
             project_path = os.path.join(BASE_PATH, PRJ_NAME)
             self.assertTrue(os.path.exists(project_path))
             print("  changes")
-            self.assertListEqual(user_files, mvc.changes())
+            self.assertCountEqual(user_files, mvc.changes())
             print("  submit")
             mvc.submit(["f1.txt"], "a single file")
             self.assertIn("f1.txt", mvc.contents())
@@ -84,7 +105,8 @@ class TestMVC(unittest.TestCase):
             print("  review")
             recipe = mvc.review()
             expected_files = ("f1.txt", "f2.txt", "f3.txt")
-            for f in expected_files:
+            self.assertNotIn("f1.txt", recipe.files_to_add)
+            for f in ("f2.txt", "f3.txt"):
                 self.assertIn(f, recipe.files_to_add)
             confirmation_dialog(recipe)
             mvc.review_finalize(recipe)
@@ -120,13 +142,15 @@ class TestMVC(unittest.TestCase):
             mvc.load_finalize(mvc.load(PRJ_NAME))
             status = mvc.status()
             print("  status:", status)
-            mvc.review_finalize(mvc.review())
+            recipe = mvc.review()
+            self.assertCountEqual(recipe.files_to_remove, ["f1.txt", "f2.txt"])
+            mvc.review_finalize(recipe)
             user_files = os.listdir(user_path)
             self.assertTrue(all(f in user_files for f in ["f4.txt", "f5.txt", "f6.txt"]))
+            self.assertFalse(any(f in user_files for f in ["f1.txt", "f2.txt"]))
             mvc.save("ready for release")
             mvc.release("second generation")
-            changes = mvc.changes()
-            self.assertTrue(all(f in changes for f in ["f2.txt", "f1.txt"]))
+            self.assertEqual(len(mvc.changes()), 0)
             print("  Done!")
 
         def subtest_5():
@@ -160,5 +184,784 @@ class TestMVC(unittest.TestCase):
         subtest_5()
         subtest_6()
 
+    def test_dedup(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        with open(os.path.join(user_path, "f2.txt"), 'w') as fd:
+            fd.write("test file 1")
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt"], "same content twice")
+        mvc.save("saved")
+        mvc.release("released")
+        objects_path = os.path.join(BASE_PATH, PRJ_NAME, "objects")
+        objects = [f for _, _, files in os.walk(objects_path) for f in files]
+        self.assertEqual(len(objects), 1)
+
+    def test_submits_after_release(self):
+        user_path = create_subws_with_files("subws1", 1, 3)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt", "f3.txt"], "three files")
+        mvc.save("saved")
+        mvc.release("first")
+        mvc.submit(["f1.txt"], "resubmit one")
+        mvc.submit(["f2.txt"], "resubmit another")
+        mvc.save("saved again")
+        mvc.release("second")
+        user_path = create_subws("subws2")
+        mvc = MiniVC(BASE_PATH, user_path)
+        recipe = mvc.load(PRJ_NAME)
+        self.assertCountEqual(recipe.files_to_add, ["f1.txt", "f2.txt", "f3.txt"])
+
+    def test_legacy_layout(self):
+        # a project as written before the blob store, with loose copies in every version
+        project_path = os.path.join(BASE_PATH, PRJ_NAME)
+        layout = {
+            os.path.join("versions", "ver1"): ({}, {"f1.txt": "test file 1", "f2.txt": "test file 2"}),
+            os.path.join("versions", "latest"): ({"f1.txt": [1, 0, 0], "f2.txt": [1, 0, 0]}, {"f3.txt": "test file 3"}),
+            os.path.join("temp", "sub1"): ({"f2.txt": [1, 0, 0], "f3.txt": [1, 1, 0]}, {"f1.txt": "altered content"}),
+        }
+        for sub_path, (include, files) in layout.items():
+            os.makedirs(os.path.join(project_path, sub_path))
+            include = {f: dict(zip(["release", "save", "submit"], i)) for f, i in include.items()}
+            with open(os.path.join(project_path, sub_path, ".mvc"), 'w') as fd:
+                json.dump({"description": [f"## {sub_path}"], "include": include}, fd)
+            for file, content in files.items():
+                with open(os.path.join(project_path, sub_path, file), 'w') as fd:
+                    fd.write(content)
+        with open(os.path.join(project_path, ".mvc"), 'w') as fd:
+            json.dump({"name": PRJ_NAME, "id": {"release": 1, "save": 1, "submit": 1}, "timestamps": {}}, fd)
+        user_path = create_subws("subws1")
+        mvc = MiniVC(BASE_PATH, user_path)
+        self.assertEqual(mvc.diff(PRJ_NAME, "latest", "dev"), FileDiff([], [], ["f1.txt"]))
+        self.assertFalse(os.path.exists(os.path.join(project_path, "versions", "latest", "f3.txt")))
+        # the import writes manifests, so versions are not resolved again
+        version = Version.load(os.path.join(project_path, "versions", "latest"))
+        self.assertEqual(version.sizes, {"f1.txt": 11, "f2.txt": 11, "f3.txt": 11})
+        recipe = mvc.load(PRJ_NAME)
+        mvc.load_finalize(recipe)
+        with open(os.path.join(user_path, "f1.txt"), 'r') as fd:
+            self.assertEqual(fd.read(), "test file 1")
+        self.assertCountEqual(mvc.load(PRJ_NAME, 1).version_files, ["f1.txt", "f2.txt"])
+        mvc.save("saved")
+        mvc.release("second")
+        self.assertEqual(mvc.diff(PRJ_NAME, 1, 2), FileDiff(["f3.txt"], [], ["f1.txt"]))
+        # a version missing a file its include points to is reported, not a KeyError
+        Version(["## broken"], {}).save(os.path.join(project_path, "versions", "ver2"))
+        Version(["## broken"], {"f1.txt": FileID(2, 0, 0)}).save(os.path.join(project_path, "versions", "latest"))
+        with self.assertRaises(MVCError):
+            mvc.diff(PRJ_NAME, 1, "latest")
+
+    def test_changes_by_content(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt"], "two files")
+        f1_path = os.path.join(user_path, "f1.txt")
+        stat = os.stat(f1_path)
+        os.utime(f1_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertNotIn("f1.txt", mvc.changes())
+        with open(f1_path, 'w') as fd:
+            fd.write("test file 2")
+        os.utime(f1_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIn("f1.txt", mvc.changes())
+
+    def test_index_racy_entries(self):
+        user_path = create_subws_with_files("subws1", 1, 1)
+        f1_path = os.path.join(user_path, "f1.txt")
+        index_path = os.path.join(user_path, INDEX_FILE)
+        stamp = os.stat(f1_path).st_mtime_ns
+        index = WorkspaceIndex(user_path)
+        self.assertEqual(index.hashes(["f1.txt"]), {"f1.txt": hash_file(f1_path)})
+        index.save()
+        # the file changes again within the timestamp tick the index was written in
+        os.utime(index_path, ns=(stamp, stamp))
+        with open(f1_path, 'w') as fd:
+            fd.write("test file 2")
+        os.utime(f1_path, ns=(stamp, stamp))
+        index = WorkspaceIndex(user_path)
+        self.assertEqual(index.hashes(["f1.txt"]), {"f1.txt": hash_file(f1_path)})
+        # once the index is newer than the file, its entry is trusted
+        index.save()
+        os.utime(index_path, ns=(stamp + 1, stamp + 1))
+        with mock.patch("mvc.index.hash_file") as hash_mock:
+            WorkspaceIndex(user_path).hashes(["f1.txt"])
+        hash_mock.assert_not_called()
+
+    def test_chunked_storage(self):
+        user_path = create_subws("subws1")
+        data = bytearray(random.Random(1).randbytes(6 << 20))
+        with open(os.path.join(user_path, "big.bin"), 'wb') as fd:
+            fd.write(data)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME, chunking=True)
+        mvc.submit(["big.bin"], "large file")
+        objects_path = os.path.join(BASE_PATH, PRJ_NAME, "objects")
+        def stored_size():
+            return sum(os.path.getsize(os.path.join(root, f))
+                       for root, _, files in os.walk(objects_path) for f in files)
+        first_size = stored_size()
+        data[1 << 20] ^= 0xff
+        with open(os.path.join(user_path, "big.bin"), 'wb') as fd:
+            fd.write(data)
+        mvc.submit(["big.bin"], "small edit")
+        self.assertLess(stored_size() - first_size, first_size // 2)
+        # an insertion only changes the chunks around it
+        second_size = stored_size()
+        data[:0] = b"inserted"
+        with open(os.path.join(user_path, "big.bin"), 'wb') as fd:
+            fd.write(data)
+        mvc.submit(["big.bin"], "insertion")
+        self.assertLess(stored_size() - second_size, first_size // 2)
+        mvc.save("saved")
+        user_path = create_subws("subws2")
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.load_finalize(mvc.load(PRJ_NAME))
+        with open(os.path.join(user_path, "big.bin"), 'rb') as fd:
+            self.assertEqual(fd.read(), data)
+
+    def test_pack(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt"], "two files")
+        mvc.save("saved")
+        mvc.release("first")
+        with open(os.path.join(user_path, "f1.txt"), 'w') as fd:
+            fd.write("altered content")
+        mvc.submit(["f1.txt"], "changed a file")
+        mvc.save("saved")
+        mvc.release("second")
+        self.assertEqual(mvc.pack(PRJ_NAME, keep=0), 3)
+        objects_path = os.path.join(BASE_PATH, PRJ_NAME, "objects")
+        self.assertEqual([f for _, _, files in os.walk(objects_path) for f in files], [])
+        user_path = create_subws("subws2")
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.load_finalize(mvc.load(PRJ_NAME, 1))
+        with open(os.path.join(user_path, "f1.txt"), 'r') as fd:
+            self.assertEqual(fd.read(), "test file 1")
+        # sizes of packed objects come from the pack index, and diffs read no objects
+        store = mvc._get_store(os.path.join(BASE_PATH, PRJ_NAME))
+        with mock.patch.object(BlobStore, "open", side_effect=AssertionError("object read")):
+            self.assertEqual(store.size(hash_file(os.path.join(user_path, "f1.txt"))), len("test file 1"))
+            self.assertEqual(mvc.diff(PRJ_NAME, 1, 2), FileDiff([], [], ["f1.txt"]))
+
+    def test_gc(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt"], "two files")
+        mvc.save("saved")
+        mvc.release("first")
+        with open(os.path.join(user_path, "f1.txt"), 'w') as fd:
+            fd.write("draft")
+        draft = hash_file(os.path.join(user_path, "f1.txt"))
+        mvc.submit(["f1.txt"], "draft")
+        with open(os.path.join(user_path, "f1.txt"), 'w') as fd:
+            fd.write("final")
+        mvc.submit(["f1.txt"], "final")
+        mvc.save("saved")
+        project_path = os.path.join(BASE_PATH, PRJ_NAME)
+        os.makedirs(os.path.join(project_path, "versions", "ver7"))
+        self.assertEqual(mvc.pack(PRJ_NAME, keep=0), 2)
+        mvc._get_store(project_path).pack_objects([draft])
+
+        report = mvc.gc(PRJ_NAME, dry_run=True)
+        self.assertEqual(report.paths, [os.path.join("versions", "ver7")])
+        self.assertEqual(report.packed, [draft])
+        self.assertEqual(report.size, len("draft"))
+        self.assertTrue(os.path.isdir(os.path.join(project_path, "versions", "ver7")))
+        self.assertEqual(mvc.gc(PRJ_NAME).packed, [draft])
+        self.assertFalse(os.path.isdir(os.path.join(project_path, "versions", "ver7")))
+        self.assertEqual(mvc.gc(PRJ_NAME).size, 0)
+
+        mvc2 = MiniVC(BASE_PATH, create_subws("subws2"))
+        mvc2.load_finalize(mvc2.load(PRJ_NAME, 1))
+        with open(os.path.join(mvc2.user_path, "f1.txt"), 'r') as fd:
+            self.assertEqual(fd.read(), "test file 1")
+        mvc2.load_finalize(mvc2.load(PRJ_NAME))
+        with open(os.path.join(mvc2.user_path, "f1.txt"), 'r') as fd:
+            self.assertEqual(fd.read(), "final")
+
+    def test_compression(self):
+        user_path = create_subws("subws1")
+        rng = random.Random(0)
+        with open(os.path.join(user_path, "log.csv"), 'w') as fd:
+            fd.writelines(f"{i},{i * i},measurement\n" for i in range(100000))
+        with open(os.path.join(user_path, "noise.bin"), 'wb') as fd:
+            fd.write(rng.randbytes(100000))
+        with open(os.path.join(user_path, "large.bin"), 'wb') as fd:
+            fd.write(bytes(5 << 20))
+        mvc = MiniVC(BASE_PATH, user_path)
+        for codec in ("zlib", "lzma", "bz2"):
+            name = f"{PRJ_NAME}_{codec}"
+            files = ["log.csv", "noise.bin", "large.bin"] if codec == "zlib" else ["log.csv", "noise.bin"]
+            mvc.create(name, chunking=True, compression=codec)
+            mvc.submit(files, "data")
+            mvc.save("saved")
+            mvc.release("first")
+            objects_path = os.path.join(BASE_PATH, name, "objects")
+            stored = {f.split(".", 1)[-1] if "." in f else "" for _, _, files in os.walk(objects_path) for f in files}
+            self.assertEqual(stored - {"chunks"}, {"", CODECS[codec].suffix[1:]})
+            self.assertLess(sum(os.path.getsize(os.path.join(r, f)) for r, _, files in os.walk(objects_path) for f in files),
+                            os.path.getsize(os.path.join(user_path, "log.csv")) + 200000)
+            for keep in (1, 0):
+                mvc.pack(name, keep)
+                mvc2 = MiniVC(BASE_PATH, create_subws("subws2"))
+                mvc2.load_finalize(mvc2.load(name))
+                for file in files:
+                    self.assertEqual(hash_file(os.path.join(mvc2.user_path, file)),
+                                     hash_file(os.path.join(user_path, file)))
+                shutil.rmtree(mvc2.user_path)
+        with self.assertRaises(MVCError):
+            mvc.create("other", compression="zip")
+
+    def test_diff(self):
+        user_path = create_subws_with_files("subws1", 1, 3)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt"], "two files")
+        mvc.save("saved")
+        mvc.release("first")
+        with open(os.path.join(user_path, "f1.txt"), 'w') as fd:
+            fd.write("altered content")
+        mvc.submit(["f1.txt", "f3.txt"], "change and add")
+        mvc.remove(["f2.txt"], "drop")
+        self.assertEqual(mvc.diff(PRJ_NAME, 1, "dev"), FileDiff(["f3.txt"], ["f2.txt"], ["f1.txt"]))
+        self.assertEqual(mvc.diff(PRJ_NAME, "latest", 1), FileDiff([], [], []))
+        mvc.save("saved")
+        mvc.release("second")
+        self.assertEqual(mvc.diff(PRJ_NAME, 2, 1), FileDiff(["f2.txt"], ["f3.txt"], ["f1.txt"]))
+        project_path = os.path.join(BASE_PATH, PRJ_NAME)
+        version = Version.load(os.path.join(project_path, "versions", "ver2"))
+        self.assertEqual(version.sizes, {"f1.txt": len("altered content"), "f3.txt": len("test file 3")})
+        # versions written without a manifest are resolved through their includes
+        version = Version.load(os.path.join(project_path, "versions", "latest"))
+        version.files, version.sizes = {}, {}
+        version.save(os.path.join(project_path, "versions", "latest"))
+        self.assertEqual(mvc.diff(PRJ_NAME, 2, "latest"), FileDiff([], [], []))
+        with self.assertRaises(MVCError):
+            mvc.diff(PRJ_NAME, 3, "latest")
+
+    def test_open(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME, compression="zlib")
+        with open(os.path.join(user_path, "f1.txt"), 'w') as fd:
+            fd.write("first " * 100)
+        mvc.submit(["f1.txt", "f2.txt"], "two files")
+        mvc.save("saved")
+        mvc.release("first")
+        with open(os.path.join(user_path, "f1.txt"), 'w') as fd:
+            fd.write("second")
+        mvc.submit(["f1.txt"], "change")
+        with mvc.open(PRJ_NAME, "f1.txt", 1) as f:
+            self.assertEqual(f.read(), b"first " * 100)
+        with mvc.open(PRJ_NAME, "./f1.txt", "dev") as f:
+            self.assertEqual(f.read(), b"second")
+        # versions written without a manifest are resolved through their includes
+        project_path = os.path.join(BASE_PATH, PRJ_NAME)
+        version = Version.load(os.path.join(project_path, "versions", "latest"))
+        version.files, version.sizes = {}, {}
+        version.save(os.path.join(project_path, "versions", "latest"))
+        with mvc.open(PRJ_NAME, "f2.txt") as f:
+            self.assertEqual(f.read(), b"test file 2")
+        with self.assertRaises(MVCError):
+            mvc.open(PRJ_NAME, "f3.txt", 1)
+        out = io.TextIOWrapper(io.BytesIO())
+        with mock.patch.dict(os.environ, {"MINIVC_BASE_PATH": BASE_PATH}), mock.patch("sys.stdout", out):
+            cli(["cat", PRJ_NAME, "f1.txt", "--version", "v1"], user_path)
+        self.assertEqual(out.buffer.getvalue(), b"first " * 100)
+
+    def test_verify(self):
+        user_path = create_subws_with_files("subws1", 1, 3)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create("other", compression="zlib")
+        mvc.submit(["f3.txt"], "one file")
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt"], "two files")
+        mvc.save("saved")
+        reports = {report.project_name: report for report in mvc.verify()}
+        self.assertEqual(reports[PRJ_NAME], VerifyReport(PRJ_NAME, 2, 22, [], []))
+        self.assertEqual(reports["other"].objects, 1)
+
+        mvc2 = MiniVC(BASE_PATH, create_subws("subws2"))
+        mvc2.load_finalize(mvc2.load(PRJ_NAME))
+        # the checked out files were hashed while they were copied
+        with Tracer() as tracer:
+            self.assertEqual(mvc2.changes(), [])
+        self.assertEqual(tracer.counters["index_misses"], 0)
+
+        objects_path = os.path.join(BASE_PATH, PRJ_NAME, "objects")
+        digests = [hash_file(os.path.join(user_path, f)) for f in ("f1.txt", "f2.txt")]
+        paths = [os.path.join(objects_path, d[:2], d[2:]) for d in digests]
+        os.chmod(paths[0], 0o644)
+        with open(paths[0], 'w') as fd:
+            fd.write("test file X")
+        os.remove(paths[1])
+        self.assertEqual(mvc.verify(PRJ_NAME), [VerifyReport(PRJ_NAME, 2, 11, [digests[0]], [digests[1]])])
+        mvc3 = MiniVC(BASE_PATH, create_subws("subws3"))
+        with self.assertRaises(MVCError):
+            mvc3.load_finalize(mvc3.load(PRJ_NAME))
+        self.assertFalse(os.path.exists(os.path.join(mvc3.user_path, "f1.txt")))
+        out = io.StringIO()
+        with mock.patch.dict(os.environ, {"MINIVC_BASE_PATH": BASE_PATH}), redirect_stdout(out):
+            cli(["verify", PRJ_NAME], user_path)
+        self.assertIn(f"corrupt\t{PRJ_NAME}\t{digests[0]}", out.getvalue())
+        self.assertIn("Error: 2 objects failed verification.", out.getvalue())
+        # a file that changes between hashing and storing is refused
+        store = mvc._get_store(os.path.join(BASE_PATH, "other"), compression="zlib")
+        for path in (os.path.join(user_path, "f1.txt"), os.path.join(user_path, "f3.txt")):
+            with self.assertRaises(MVCError):
+                store.put(path, "0" * 64)
+        self.assertFalse(store.has("0" * 64))
+
+    def test_each(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc = MiniVC(BASE_PATH, user_path)
+        names = [f"prj{i}" for i in range(6)]
+        for name in names:
+            mvc.create(name)
+        mvc.batch([{"op": "submit", "project": name, "files": ["f1.txt", "f2.txt"]} for name in names[:4]])
+        results = mvc.each(names[:4] + ["missing"], "save", "nightly", concurrency=3)
+        self.assertEqual([r.project_name for r in results], names[:4] + ["missing"])
+        self.assertEqual([r.result for r in results[:4]], ["v0.1.0"] * 4)
+        self.assertEqual(results[4].error, "Invalid project name.")
+        self.assertEqual(mvc.each(names[:2], "status")[0].result[:2], ["## v0.1.0", "nightly"])
+        self.assertEqual(mvc.each(names[:1], "verify")[0].result.objects, 2)
+        with self.assertRaises(MVCError):
+            mvc.each(names, "load")
+
+        active, peak = [0], [0]
+        lock = threading.Lock()
+        run_on_project = mvc._run_on_project
+        def counted(*args):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            try:
+                time.sleep(0.05)
+                return run_on_project(*args)
+            finally:
+                with lock:
+                    active[0] -= 1
+        with mock.patch.object(mvc, "_run_on_project", counted):
+            mvc.each(names, "contents", concurrency=2)
+        self.assertEqual(peak[0], 2)
+
+        mvc.batch([{"op": "submit", "project": "prj5", "files": ["f1.txt"]}])
+        out = io.StringIO()
+        with mock.patch.dict(os.environ, {"MINIVC_BASE_PATH": BASE_PATH}), redirect_stdout(out):
+            cli(["each", "--pending", "save", "-d", "weekly"], user_path)
+            cli(["each", "--projects", "prj0,prj5", "--projects", "nope", "contents"], user_path)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "prj5\tv0.1.0",
+            'prj0\t["f1.txt", "f2.txt"]',
+            'prj5\t["f1.txt"]',
+            "nope\tError: Invalid project name.",
+            "Error: 1 of 3 projects failed.",
+        ])
+
+    def test_list_projects(self):
+        user_path = create_subws_with_files("subws1", 1, 1)
+        mvc = MiniVC(BASE_PATH, user_path)
+        for name in ("alpha", "beta1", "beta2", "beta3"):
+            mvc.create(name)
+        mvc.submit(["f1.txt"], "pending work")
+        self.assertListEqual(list(mvc.list_projects("beta")), ["beta1", "beta2", "beta3"])
+        self.assertListEqual(list(mvc.list_projects("beta", offset=1, limit=1)), ["beta2"])
+        self.assertListEqual(list(mvc.list_projects(pending=True)), ["beta3"])
+        with open(os.path.join(BASE_PATH, "stray.txt"), 'w') as fd:
+            fd.write("not a project")
+        os.remove(os.path.join(BASE_PATH, ".mvc-catalog.db"))
+        # a commit while the catalog is missing must not leave one listing only that project
+        mvc.submit(["f1.txt"], "more pending work")
+        self.assertEqual(len(mvc.list_projects()), 4)
+        os.remove(os.path.join(BASE_PATH, ".mvc-catalog.db"))
+        self.assertEqual(mvc.rebuild_catalog(), 4)
+        self.assertEqual(mvc.list_projects()["beta3"], "v0.0.2")
+
+    def test_concurrent_submits(self):
+        user_path = create_subws("subws1")
+        MiniVC(BASE_PATH, user_path).create(PRJ_NAME)
+        def worker(i):
+            user_path = create_subws_with_files(f"subws{i}", i, i)
+            mvc = MiniVC(BASE_PATH, user_path)
+            mvc.load_finalize(mvc.load(PRJ_NAME))
+            mvc.submit([f"f{i}.txt"], f"file {i}")
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(2, 7)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        mvc = MiniVC(BASE_PATH, user_path)
+        self.assertEqual(mvc.list_projects()[PRJ_NAME], "v0.0.5")
+        mvc.save("all submits")
+        recipe = mvc.load(PRJ_NAME)
+        self.assertCountEqual(recipe.files_to_add, [f"f{i}.txt" for i in range(2, 7)])
+
+    def test_stale_locks(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        lock_path = os.path.join(BASE_PATH, PRJ_NAME, LOCK_FILE)
+        # left empty by a process that died right after creating it
+        open(lock_path, 'w').close()
+        os.utime(lock_path, (time.time() - 60, time.time() - 60))
+        mvc.submit(["f1.txt"], "first")
+        self.assertFalse(os.path.exists(lock_path))
+        with open(lock_path, 'w') as fd:
+            json.dump({"host": "elsewhere", "pid": 1, "token": "t", "acquired": time.time() - 3600}, fd)
+        with self.assertRaisesRegex(MVCError, "elsewhere:1 since"):
+            ProjectLock(os.path.join(BASE_PATH, PRJ_NAME), timeout=0.05).acquire()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            cli(["unlock", PRJ_NAME], user_path)
+            cli(["unlock", PRJ_NAME], user_path)
+        self.assertEqual(out.getvalue(), "removed lock of elsewhere:1\nError: Project is not locked.\n")
+        mvc.submit(["f2.txt"], "second")
+        self.assertEqual(mvc.list_projects()[PRJ_NAME], "v0.0.2")
+
+    def test_batch(self):
+        user_path = create_subws_with_files("subws1", 1, 4)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create("other")
+        mvc.create(PRJ_NAME)
+        result = mvc.batch([
+            {"op": "submit", "files": ["f1.txt", "f2.txt"], "comment": "two files"},
+            {"op": "submit", "project": "other", "files": ["f3.txt"]},
+            {"op": "remove", "files": ["f2.txt"]},
+            {"op": "save", "comment": "first save"},
+            {"op": "submit", "files": ["f4.txt"]},
+            {"op": "save", "project": "other"},
+        ])
+        self.assertDictEqual(result, {"other": "v0.1.0", PRJ_NAME: "v0.1.1"})
+        self.assertCountEqual(mvc.contents(), ["f1.txt", "f4.txt"])
+        # malformed steps are refused before anything is stored
+        for step in ({"op": "submit", "files": "f1.txt"}, {"op": "remove"}, {"op": "save", "project": 1}, "save"):
+            with self.assertRaisesRegex(MVCError, "step 1"):
+                mvc.batch([{"op": "submit", "files": ["f3.txt"]}, step])
+        self.assertCountEqual(mvc.contents(), ["f1.txt", "f4.txt"])
+        mvc.save("second save")
+        user_path = create_subws("subws2")
+        mvc = MiniVC(BASE_PATH, user_path)
+        self.assertCountEqual(mvc.load(PRJ_NAME).files_to_add, ["f1.txt", "f4.txt"])
+        self.assertCountEqual(mvc.load("other").files_to_add, ["f3.txt"])
+
+    def test_metadata_format(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc = MiniVC(BASE_PATH, user_path)
+        mvc.create(PRJ_NAME)
+        mvc.submit(["f1.txt", "f2.txt"], "two files")
+        project_path = os.path.join(BASE_PATH, PRJ_NAME)
+        project = Project.load(project_path)
+        self.assertEqual(str(project.id), "v0.0.1")
+        self.assertIn("timestamps", project._lazy.sections)
+        self.assertIn("f1.txt", project.timestamps)
+        self.assertNotIn("timestamps", project._lazy.sections)
+        Project.metadata_format = "json"
+        try:
+            project.save(project_path)
+        finally:
+            del Project.metadata_format
+        with open(os.path.join(project_path, ".mvc"), 'r') as fd:
+            self.assertEqual(json.load(fd)["id"]["submit"], 1)
+        mvc.submit(["f1.txt"], "migrated")
+        with open(os.path.join(project_path, ".mvc"), 'rb') as fd:
+            self.assertEqual(fd.read(4), b"MVCB")
+        self.assertDictEqual(Project.load(project_path).hashes, project.hashes)
+
+    def test_async(self):
+        async def scenario():
+            owner = AsyncMiniVC(BASE_PATH, create_subws("subws1"), concurrency=2)
+            await owner.create(PRJ_NAME)
+            async def user(i):
+                mvc = AsyncMiniVC(BASE_PATH, create_subws_with_files(f"subws{i}", i, i))
+                await mvc.load_finalize(await mvc.load(PRJ_NAME))
+                await mvc.submit([f"f{i}.txt"], f"file {i}")
+            await asyncio.gather(*(user(i) for i in range(2, 5)))
+            self.assertEqual(len(await owner.status()), 12)
+            await owner.save("async save")
+            return await owner.list_projects()
+        self.assertEqual(asyncio.run(scenario())[PRJ_NAME], "v0.1.0")
+        # operations on one workspace run one at a time, so none of them loses the others' updates
+        user_path = create_subws_with_files("subws5", 1, 6)
+        async def same_workspace():
+            mvc = AsyncMiniVC(BASE_PATH, user_path, concurrency=6)
+            await mvc.load_finalize(await mvc.load(PRJ_NAME))
+            await asyncio.gather(*(mvc.submit([f"f{i}.txt"], f"file {i}") for i in range(1, 7)))
+            return await mvc.changes()
+        self.assertEqual(asyncio.run(same_workspace()), [])
+        self.assertTrue(all(f"f{i}.txt" in Workspace.load(user_path).files for i in range(1, 7)))
+
+    def test_profile(self):
+        mvc1 = MiniVC(BASE_PATH, create_subws_with_files("subws1", 1, 2))
+        mvc1.create(PRJ_NAME)
+        with Tracer() as tracer:
+            mvc1.submit(["f1.txt", "f2.txt"], "two files")
+            mvc1.save("first")
+        report = tracer.report()
+        self.assertEqual(report["counters"]["files_hashed"], 2)
+        self.assertEqual(report["counters"]["objects_written"], 2)
+        self.assertGreater(report["counters"]["metadata_writes"], 0)
+        self.assertEqual(report["phases"]["save"]["calls"], 1)
+        self.assertIn("batch.store", report["phases"])
+
+        mvc2 = MiniVC(BASE_PATH, create_subws("subws2"))
+        trace_file = os.path.join(BASE_PATH, "trace.json")
+        with Tracer() as tracer:
+            mvc2.load_finalize(mvc2.load(PRJ_NAME))
+        tracer.write_chrome_trace(trace_file)
+        self.assertEqual(tracer.report()["counters"]["files_copied"], 2)
+        self.assertGreater(tracer.report()["counters"]["bytes_copied"], 0)
+        with open(trace_file, 'r') as f:
+            events = json.load(f)["traceEvents"]
+        self.assertIn("load_finalize", {event["name"] for event in events})
+        # work started by other threads meanwhile is not counted
+        with Tracer() as tracer:
+            thread = threading.Thread(target=mvc2.status)
+            thread.start()
+            thread.join()
+        self.assertEqual(tracer.report(), {"counters": {}, "phases": {}})
+
+    def test_metadata_cache(self):
+        mvc1 = MiniVC(BASE_PATH, create_subws_with_files("subws1", 1, 1))
+        mvc1.create(PRJ_NAME)
+        project_path = os.path.join(BASE_PATH, PRJ_NAME)
+        cache = MetadataCache()
+        with mock.patch.object(JSONBase, "cache", cache):
+            project = Project.load(project_path)
+            project.timestamps["changed"] = "in memory"
+            self.assertNotIn("changed", Project.load(project_path).timestamps)
+            with Tracer() as tracer:
+                Project.load(project_path)
+            self.assertEqual(tracer.report()["counters"], {"metadata_cache_hits": 1})
+            mvc1.submit(["f1.txt"], "one file")
+            self.assertEqual(str(Project.load(project_path).id), "v0.0.1")
+
+    def test_daemon(self):
+        socket_path = os.path.join(BASE_PATH, daemon.SOCKET_FILE)
+        user_path = create_subws_with_files("subws1", 1, 1)
+        self.assertIsNone(daemon.forward(socket_path, ["list"], user_path))
+        out = io.StringIO()
+        with mock.patch.dict(os.environ, {"MINIVC_BASE_PATH": BASE_PATH}), \
+                daemon.Daemon(socket_path, cli) as server:
+            threading.Thread(target=server.serve_forever).start()
+            try:
+                with redirect_stdout(out):
+                    self.assertEqual(daemon.forward(socket_path, ["create", PRJ_NAME], user_path), 0)
+                    self.assertEqual(daemon.forward(socket_path, ["submit", "f1.txt"], user_path), 0)
+                    self.assertEqual(daemon.forward(socket_path, ["list"], user_path), 0)
+                    self.assertEqual(daemon.forward(socket_path, ["save", "--bogus"], user_path), 2)
+                    self.assertEqual(daemon.forward(socket_path, ["load", "nope"], user_path), 1)
+                self.assertEqual(stat.S_IMODE(os.stat(socket_path).st_mode), 0o600)
+            finally:
+                server.shutdown()
+        self.assertEqual(out.getvalue(), f"{PRJ_NAME}\tv0.0.1\nError: Invalid project name.\n")
+        self.assertFalse(os.path.exists(socket_path))
+        # without a daemon, the entry point runs the command itself
+        with mock.patch.dict(os.environ, {"MINIVC_BASE_PATH": BASE_PATH, "MINIVC_SOCKET": socket_path}), \
+                redirect_stdout(io.StringIO()) as out, self.assertRaises(SystemExit) as exit:
+            main(["list"])
+        self.assertEqual((exit.exception.code, out.getvalue()), (0, f"{PRJ_NAME}\tv0.0.1\n"))
+        with mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": ""}):
+            os.environ.pop("MINIVC_SOCKET", None)
+            runtime_path = os.path.dirname(daemon.get_socket_path(BASE_PATH))
+        self.assertEqual(stat.S_IMODE(os.stat(runtime_path).st_mode), 0o700)
+        # a runtime directory that is not private only disables forwarding
+        os.chmod(runtime_path, 0o755)
+        try:
+            with mock.patch.dict(os.environ, {"MINIVC_BASE_PATH": BASE_PATH, "XDG_RUNTIME_DIR": ""}), \
+                    redirect_stdout(io.StringIO()) as out, redirect_stderr(io.StringIO()) as err, \
+                    self.assertRaises(SystemExit) as exit:
+                os.environ.pop("MINIVC_SOCKET", None)
+                main(["list"])
+        finally:
+            os.chmod(runtime_path, 0o700)
+        self.assertEqual((exit.exception.code, out.getvalue()), (0, f"{PRJ_NAME}\tv0.0.1\n"))
+        self.assertIn("not a private directory", err.getvalue())
+
+    def test_nested_tree(self):
+        user_path = create_subws("subws1")
+        for file in ["src/a.txt", "src/lib/b.txt", "src/lib/debug.log", "build/out.o"]:
+            os.makedirs(os.path.dirname(os.path.join(user_path, file)), exist_ok=True)
+            with open(os.path.join(user_path, file), 'w') as fd:
+                fd.write(file)
+        with open(os.path.join(user_path, ".mvcignore"), 'w') as fd:
+            fd.write("# build outputs\nbuild/\n*.log\n")
+        mvc1 = MiniVC(BASE_PATH, user_path)
+        mvc1.create(PRJ_NAME)
+        mvc1.submit(["."], "whole tree")
+        self.assertEqual(sorted(mvc1.contents()), [".mvcignore", "src/a.txt", "src/lib/b.txt"])
+        self.assertEqual(mvc1.changes(), [])
+        with open(os.path.join(user_path, "src", "lib", "b.txt"), 'w') as fd:
+            fd.write("changed")
+        self.assertEqual(mvc1.changes(), ["src/lib/b.txt"])
+        mvc1.save("first")
+
+        mvc2 = MiniVC(BASE_PATH, create_subws("subws2"))
+        mvc2.load_finalize(mvc2.load(PRJ_NAME))
+        with open(os.path.join(mvc2.user_path, "src", "lib", "b.txt"), 'r') as fd:
+            self.assertEqual(fd.read(), "src/lib/b.txt")
+        mvc1.remove(["src/lib/"], "drop lib")
+        self.assertEqual(sorted(mvc1.contents()), [".mvcignore", "src/a.txt"])
+        mvc1.save("second")
+        mvc2.load_finalize(mvc2.load(PRJ_NAME))
+        self.assertFalse(os.path.exists(os.path.join(mvc2.user_path, "src", "lib")))
+        self.assertTrue(os.path.exists(os.path.join(mvc2.user_path, "src", "a.txt")))
+
+    def test_sparse_checkout(self):
+        user_path = create_subws("subws1")
+        files = ["src/a.txt", "src/lib/b.txt", "src/lib/b.log", "docs/c.txt", "d.txt"]
+        for file in files:
+            os.makedirs(os.path.dirname(os.path.join(user_path, file)), exist_ok=True)
+            with open(os.path.join(user_path, file), 'w') as fd:
+                fd.write(file)
+        mvc1 = MiniVC(BASE_PATH, user_path)
+        mvc1.create(PRJ_NAME)
+        mvc1.submit(["."], "whole tree")
+        mvc1.save("first")
+
+        mvc2 = MiniVC(BASE_PATH, create_subws("subws2"))
+        recipe = mvc2.load(PRJ_NAME, include=["src"], exclude=["*.log"])
+        self.assertEqual(sorted(recipe.files_to_add), ["src/a.txt", "src/lib/b.txt"])
+        mvc2.load_finalize(recipe)
+        self.assertFalse(os.path.exists(os.path.join(mvc2.user_path, "d.txt")))
+        # a later load keeps the patterns, an empty include widens the checkout again
+        mvc1.submit(["d.txt", "src/a.txt"], "touch")
+        mvc1.save("second")
+        self.assertEqual(mvc2.load(PRJ_NAME).files_to_add, {})
+        recipe = mvc2.load(PRJ_NAME, include=[], exclude=["src/lib"])
+        self.assertEqual(sorted(recipe.files_to_add), ["d.txt", "docs/c.txt"])
+        self.assertEqual(recipe.files_to_remove, ["src/lib/b.txt"])
+
+        mvc3 = MiniVC(BASE_PATH, create_subws("subws3"))
+        recipe = mvc3.load(PRJ_NAME, lazy=True)
+        self.assertEqual(recipe.files_to_add, {})
+        mvc3.load_finalize(recipe)
+        self.assertEqual(sorted(os.listdir(mvc3.user_path)), [".mvc", ".mvcindex", "changelog.md"])
+        self.assertEqual(mvc3.fetch(["src/lib/*.txt", "docs"]), ["docs/c.txt", "src/lib/b.txt"])
+        with open(os.path.join(mvc3.user_path, "src", "lib", "b.txt"), 'r') as fd:
+            self.assertEqual(fd.read(), "src/lib/b.txt")
+        self.assertEqual(mvc3.changes(), [])
+        with self.assertRaisesRegex(MVCError, "mvc fetch src/a.txt"):
+            mvc3.submit(["src/a.txt"], "not fetched")
+        mvc3.remove(["d.txt"], "drop")
+        self.assertEqual(mvc3.fetch(), ["src/a.txt", "src/lib/b.log"])
+        self.assertEqual(mvc3.fetch(), [])
+        self.assertFalse(os.path.exists(os.path.join(mvc3.user_path, "d.txt")))
+
+    def test_link_modes(self):
+        user_path = create_subws_with_files("subws1", 1, 2)
+        mvc1 = MiniVC(BASE_PATH, user_path)
+        mvc1.create(PRJ_NAME)
+        mvc1.submit(["f1.txt", "f2.txt"], "two files")
+        mvc1.save("first")
+        digest = hash_file(os.path.join(user_path, "f1.txt"))
+        object_path = os.path.join(BASE_PATH, PRJ_NAME, "objects", digest[:2], digest[2:])
+
+        mvc2 = MiniVC(BASE_PATH, create_subws("subws2"), link="hardlink")
+        mvc2.load_finalize(mvc2.load(PRJ_NAME))
+        st = os.stat(os.path.join(mvc2.user_path, "f1.txt"))
+        self.assertEqual(st.st_ino, os.stat(object_path).st_ino)
+        self.assertEqual(st.st_mode & 0o222, 0)
+        with open(os.path.join(user_path, "f1.txt"), 'w') as fd:
+            fd.write("altered content")
+        mvc1.submit(["f1.txt"], "change")
+        mvc1.save("second")
+        # a new version replaces the link instead of writing through it
+        mvc2.load_finalize(mvc2.load(PRJ_NAME))
+        with open(os.path.join(mvc2.user_path, "f1.txt"), 'r') as fd:
+            self.assertEqual(fd.read(), "altered content")
+        self.assertEqual(hash_file(object_path), digest)
+
+        mvc3 = MiniVC(BASE_PATH, create_subws("subws3"), link="copy")
+        mvc3.load_finalize(mvc3.load(PRJ_NAME))
+        self.assertNotEqual(os.stat(os.path.join(mvc3.user_path, "f2.txt")).st_ino,
+                            os.stat(os.path.join(mvc2.user_path, "f2.txt")).st_ino)
+        probe_path = os.path.join(BASE_PATH, "probe")
+        os.makedirs(probe_path)
+        with mock.patch("mvc.transfer._reflink", return_value=True):
+            self.assertEqual(detect_link_mode(probe_path), "reflink")
+        # a reflink moves no bytes, so the clone is hashed before it is stored
+        def reflink_changed(infd, outfd):
+            os.write(outfd, b"changed after hashing")
+            return True
+        store = BlobStore(os.path.join(BASE_PATH, "reflinked"), link="reflink")
+        src_path = os.path.join(user_path, "f2.txt")
+        src_digest = hash_file(src_path)
+        with mock.patch("mvc.transfer._reflink", side_effect=reflink_changed):
+            with self.assertRaises(IntegrityError):
+                store.put(src_path, src_digest)
+        self.assertFalse(store.has(src_digest))
+        with self.assertRaises(MVCError):
+            MiniVC(BASE_PATH, user_path, link="symlink")
+
+    def test_remote(self):
+        user_path = create_subws_with_files("subws1", 1, 3)
+        os.makedirs(os.path.join(user_path, "src"))
+        with open(os.path.join(user_path, "src", "copy.txt"), 'w') as fd:
+            fd.write("test file 1")
+        with MVCServer(BASE_PATH, "127.0.0.1", 0) as server:
+            threading.Thread(target=server.serve_forever).start()
+            try:
+                url = f"http://127.0.0.1:{server.server_port}"
+                mvc1 = RemoteMiniVC(url, user_path)
+                mvc1.create(PRJ_NAME, compression="zlib")
+                with Tracer() as tracer:
+                    mvc1.submit(["."], "whole tree")
+                # one missing check and one upload for all files, then the batch itself
+                self.assertEqual(tracer.counters["http_requests"], 3)
+                self.assertEqual(mvc1.changes(), [])
+                mvc1.save("first")
+                mvc1.release("one")
+                self.assertEqual(mvc1.list_projects(), {PRJ_NAME: "v1.0.0"})
+                with open(os.path.join(user_path, "f2.txt"), 'w') as fd:
+                    fd.write("changed")
+                mvc1.submit(["f2.txt"], "change")
+                self.assertEqual(mvc1.diff(PRJ_NAME, 1, "dev"), FileDiff([], [], ["f2.txt"]))
+                for version, content in [(1, b"test file 2"), ("dev", b"changed")]:
+                    with mvc1.open(PRJ_NAME, "f2.txt", version) as f:
+                        self.assertEqual(f.read(), content)
+
+                mvc2 = RemoteMiniVC(url, create_subws("subws2"))
+                mvc2.load_finalize(mvc2.load(PRJ_NAME))
+                for file, content in [("f2.txt", "test file 2"), ("src/copy.txt", "test file 1")]:
+                    with open(os.path.join(mvc2.user_path, file), 'r') as fd:
+                        self.assertEqual(fd.read(), content)
+                self.assertEqual(mvc2.status(), mvc1.status())
+                self.assertEqual(mvc2.verify(PRJ_NAME)[0].objects, 4)
+                self.assertEqual(mvc2.each([PRJ_NAME, "missing"], "status")[0].result, mvc1.status())
+                with self.assertRaises(MVCError):
+                    mvc2.load("missing")
+                # each lists the projects through the server when none are named
+                out = io.StringIO()
+                with mock.patch.dict(os.environ, {"MINIVC_BASE_PATH": url}), redirect_stdout(out):
+                    self.assertEqual(cli(["each", "--pending", "contents"], mvc2.user_path), 0)
+                    self.assertEqual(cli(["each", "--prefix", "nope", "status"], mvc2.user_path), 0)
+                self.assertEqual(out.getvalue().splitlines(),
+                                 [f"{PRJ_NAME}\t{json.dumps(mvc1.contents())}"])
+                # names reaching outside the base path are refused by the server too
+                for name in ("..", f"../{os.path.basename(BASE_PATH)}/{PRJ_NAME}", os.path.abspath(BASE_PATH)):
+                    with self.assertRaises(MVCError):
+                        mvc2.load(name)
+                    with self.assertRaises(MVCError):
+                        mvc2.create(name)
+                # so are digests that would name paths outside the store
+                for action in ("missing", "fetch"):
+                    with self.assertRaisesRegex(MVCError, "Invalid digest"):
+                        mvc2.pool.call(mvc2._objects_path(PRJ_NAME, action), ["ab/../../../etc/passwd"])
+                with self.assertRaisesRegex(MVCError, "Invalid file info"):
+                    mvc2._call("_apply_batch", [{"op": "submit", "project": PRJ_NAME, "files": ["f1.txt"]}],
+                               {"f1.txt": ["../" * 4 + "etc/passwd", 1, 0]})
+            finally:
+                server.shutdown()
+        with self.assertRaises(MVCError):
+            MVCServer(BASE_PATH, "0.0.0.0", 0)
+        # a batch whose content was never uploaded is refused by the server
+        with self.assertRaises(MVCError):
+            server.mvc._apply_batch([{"op": "submit", "project": PRJ_NAME, "files": ["f9.txt"]}],
+                                    {"f9.txt": ["0" * 64, 1, 0]})
+
 if __name__ == '__main__':
     unittest.main()